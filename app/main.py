@@ -2,17 +2,62 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 
 from app.routers.line import router as line_router
 from app.routers.google_auth import router as google_auth_router
 
 
-app = FastAPI(title="AI予定管理秘書アプリ")
+def _configure_logging() -> None:
+    """ルートロガーを一度だけ設定する
+
+    QueueHandler + QueueListenerでログI/Oをバックグラウンドスレッドに
+    逃がし、リクエストハンドラがwrite()でブロックしないようにする。
+    """
+    root = logging.getLogger()
+    if root.handlers:
+        return
+
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(
+        logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+    )
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+
 
-app.add_middleware(
-    CORSMiddleware,
+_configure_logging()
+
+# orjsonは標準jsonより高速にシリアライズし、bytesを直接返すため
+# Webhookのような高QPSエンドポイントのレスポンスコストを下げる
+api = FastAPI(title="AI予定管理秘書アプリ", default_response_class=ORJSONResponse)
+
+
+@api.get("/")
+async def root():
+    return {"message": "AI予定管理秘書アプリのバックエンドAPIへようこそ"}
+
+
+api.include_router(line_router)
+api.include_router(google_auth_router)
+
+# CORSを必要とするのはブラウザ向けのエンドポイントのみ。
+# LINE Webhookはサーバー間通信のため、ミドルウェアのラップコストを避ける。
+_cors_app = CORSMiddleware(
+    api,
     allow_origins=["*"],  # 本番環境では適切に制限する
     allow_credentials=True,
     allow_methods=["*"],
@@ -20,10 +65,18 @@ app.add_middleware(
 )
 
 
-@app.get("/")
-async def root():
-    return {"message": "AI予定管理秘書アプリのバックエンドAPIへようこそ"}
+class _SkipCORSForWebhook:
+    """/line/ 配下のリクエストをCORSミドルウェアを通さず直接処理するASGIラッパー"""
+
+    def __init__(self, inner_app, cors_app):
+        self.inner_app = inner_app
+        self.cors_app = cors_app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith("/line/"):
+            await self.inner_app(scope, receive, send)
+        else:
+            await self.cors_app(scope, receive, send)
 
 
-app.include_router(line_router)
-app.include_router(google_auth_router)
+app = _SkipCORSForWebhook(api, _cors_app)
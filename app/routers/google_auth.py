@@ -1,3 +1,5 @@
+import asyncio
+import logging
 import os
 from fastapi import APIRouter, Request, HTTPException, Depends, Response
 from fastapi.responses import RedirectResponse
@@ -5,78 +7,37 @@ from google_auth_oauthlib.flow import Flow
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request as GoogleRequest
 
-from app.services.database import save_user_tokens, get_user_tokens
+from app.services.database_factory import save_user_tokens, get_user_tokens
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/google", tags=["google"])
 
+# 環境変数はインポート時に一度だけ解決する
+APP_BASE_URL = os.getenv("APP_BASE_URL")
+REDIRECT_URI = f"{APP_BASE_URL}/google/oauth2callback"
+
 CLIENT_CONFIG = {
     "web": {
         "client_id": os.getenv("GOOGLE_CLIENT_ID"),
         "client_secret": os.getenv("GOOGLE_CLIENT_SECRET"),
         "auth_uri": "https://accounts.google.com/o/oauth2/auth",
         "token_uri": "https://oauth2.googleapis.com/token",
-        "redirect_uris": [f"{os.getenv('APP_BASE_URL')}/google/oauth2callback"]
+        "redirect_uris": [REDIRECT_URI]
     }
 }
 
 SCOPES = ["https://www.googleapis.com/auth/calendar"]
 
-@router.get("/authorize")
-async def authorize(user_id: str):
-    flow = Flow.from_client_config(
-        client_config=CLIENT_CONFIG,
-        scopes=SCOPES
-    )
-    flow.redirect_uri = f"{os.getenv('APP_BASE_URL')}/google/oauth2callback"
-    
-    authorization_url, state = flow.authorization_url(
-        access_type="offline",
-        include_granted_scopes="true",
-        prompt="consent",  # 毎回同意画面を表示し、リフレッシュトークンを確実に取得
-        state=user_id
-    )
-    
-    return RedirectResponse(authorization_url)
 
-@router.get("/oauth2callback")
-async def oauth2callback(request: Request):
-    query_params = dict(request.query_params)
-    code = query_params.get("code")
-    state = query_params.get("state")  # stateにはuser_idが含まれている
-    
-    if not code or not state:
-        raise HTTPException(status_code=400, detail="Invalid request")
-    
-    flow = Flow.from_client_config(
-        client_config=CLIENT_CONFIG,
-        scopes=SCOPES
-    )
-    flow.redirect_uri = f"{os.getenv('APP_BASE_URL')}/google/oauth2callback"
-    
-    flow.fetch_token(code=code)
-    credentials = flow.credentials
-    
-    # デバッグ情報を出力
-    print(f"OAuth2コールバック - ユーザーID: {state}")
-    print(f"取得したトークン情報:")
-    print(f"  - アクセストークン: {credentials.token[:10]}...")
-    print(f"  - リフレッシュトークン: {credentials.refresh_token[:10] if credentials.refresh_token else 'なし'}")
-    print(f"  - トークンURI: {credentials.token_uri}")
-    print(f"  - スコープ: {credentials.scopes}")
-    
-    user_id = state
-    token_info = {
-        "token": credentials.token,
-        "refresh_token": credentials.refresh_token,
-        "token_uri": credentials.token_uri,
-        "client_id": credentials.client_id,
-        "client_secret": credentials.client_secret,
-        "scopes": credentials.scopes
-    }
-    save_user_tokens(user_id, token_info)
-    
-    # HTMLレスポンスを返す（LINEに戻るための指示を含む）
-    html_content = """
+def _new_flow() -> Flow:
+    """スナップショット済みの設定からOAuthフローを構築する"""
+    flow = Flow.from_client_config(client_config=CLIENT_CONFIG, scopes=SCOPES)
+    flow.redirect_uri = REDIRECT_URI
+    return flow
+
+# 認証完了ページは固定内容のため、インポート時に一度だけバイト列化しておく
+_OAUTH_SUCCESS_HTML: bytes = """
     <!DOCTYPE html>
     <html>
     <head>
@@ -123,5 +84,56 @@ async def oauth2callback(request: Request):
         </div>
     </body>
     </html>
-    """
-    return Response(content=html_content, media_type="text/html")
+    """.encode("utf-8")
+
+@router.get("/authorize")
+async def authorize(user_id: str):
+    flow = _new_flow()
+
+    authorization_url, state = flow.authorization_url(
+        access_type="offline",
+        include_granted_scopes="true",
+        prompt="consent",  # 毎回同意画面を表示し、リフレッシュトークンを確実に取得
+        state=user_id
+    )
+    
+    return RedirectResponse(authorization_url)
+
+@router.get("/oauth2callback")
+async def oauth2callback(request: Request):
+    query_params = dict(request.query_params)
+    code = query_params.get("code")
+    state = query_params.get("state")  # stateにはuser_idが含まれている
+    
+    if not code or not state:
+        raise HTTPException(status_code=400, detail="Invalid request")
+    
+    flow = _new_flow()
+
+    # Googleへのトークン交換はブロッキングHTTPなのでスレッドに逃がす
+    await asyncio.to_thread(flow.fetch_token, code=code)
+    credentials = flow.credentials
+    
+    # デバッグ情報を出力（%スタイルでフォーマットを遅延させる）
+    logger.debug("OAuth2コールバック - ユーザーID: %s", state)
+    logger.debug("リフレッシュトークン取得: %s", "あり" if credentials.refresh_token else "なし")
+    logger.debug("スコープ: %s", credentials.scopes)
+    
+    user_id = state
+    token_info = {
+        "token": credentials.token,
+        "refresh_token": credentials.refresh_token,
+        "token_uri": credentials.token_uri,
+        "client_id": credentials.client_id,
+        "client_secret": credentials.client_secret,
+        "scopes": credentials.scopes
+    }
+    save_user_tokens(user_id, token_info)
+
+    # 認証状態キャッシュを無効化して、直後のメッセージで新しい状態を反映させる
+    from app.routers.line import invalidate_auth_cache
+    invalidate_auth_cache(user_id)
+
+    # HTMLレスポンスを返す（LINEに戻るための指示を含む）
+    # bytesを渡すことでStarlette側の再エンコードをスキップする
+    return Response(content=_OAUTH_SUCCESS_HTML, media_type="text/html; charset=utf-8")
@@ -1,55 +1,155 @@
+import asyncio
+import base64
+import hashlib
+import hmac
 import os
-from fastapi import APIRouter, Request, BackgroundTasks
+import logging
+import re
+import threading
+from fastapi import APIRouter, Request
 from linebot.v3.webhooks import MessageEvent, PostbackEvent
 from linebot.v3.exceptions import InvalidSignatureError
-from linebot.v3.messaging import Configuration, ApiClient, MessagingApi, ReplyMessageRequest, TextMessage
+from linebot.v3.messaging import (
+    Configuration,
+    AsyncApiClient,
+    AsyncMessagingApi,
+    ReplyMessageRequest,
+    TextMessage,
+)
 from linebot.v3.webhooks.models import TextMessageContent
 from linebot.v3.webhook import WebhookParser
+from cachetools import TTLCache
 
 from app.services.group_scheduler import process_vote, close_voting
 from app.services.google_calendar import check_user_auth_status
-from app.services.langgraph_processor import process_user_message
+from app.services.langgraph_processor import aprocess_user_message
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/line", tags=["line"])
 
+# 認証が必要なカレンダー関連キーワード（モジュール読み込み時にコンパイル）
+_AUTH_KEYWORDS_RE = re.compile("カレンダー|予定|会議|ミーティング|スケジュール")
+
+# 認証状態のTTLキャッシュ（トークン状態はめったに変わらないため、
+# 同一ユーザーからの連続メッセージでDBアクセスを省略する）
+_auth_cache = TTLCache(maxsize=10_000, ttl=60)
+# to_threadワーカーから並行アクセスされ、TTLCacheはスレッドセーフではないためロックで守る
+_auth_cache_lock = threading.Lock()
+
+
+def _check_user_auth_cached(user_id: str) -> bool:
+    """認証状態をキャッシュ経由で確認する"""
+    with _auth_cache_lock:
+        cached = _auth_cache.get(user_id)
+    if cached is not None:
+        return cached
+    result = check_user_auth_status(user_id)
+    with _auth_cache_lock:
+        _auth_cache[user_id] = result
+    return result
+
+
+def invalidate_auth_cache(user_id: str) -> None:
+    """認証状態キャッシュを無効化する（OAuth認証完了時に呼び出す）"""
+    with _auth_cache_lock:
+        _auth_cache.pop(user_id, None)
+
 line_token = os.getenv("LINE_CHANNEL_ACCESS_TOKEN", "dummy_token")
 line_secret = os.getenv("LINE_CHANNEL_SECRET", "dummy_secret")
 
+# 認証URLのテンプレートはインポート時に一度だけ構築する
+_AUTH_URL_TMPL = f"{os.getenv('APP_BASE_URL')}/google/authorize?user_id={{}}"
+
 configuration = Configuration(access_token=line_token)
 
+# パーサーはシークレット以外の状態を持たないため、モジュール読み込み時に1回だけ構築する
+_parser = WebhookParser(line_secret)
+
+# 実行中タスクへの参照を保持してGCによる回収を防ぐ（asyncioドキュメントの推奨）
+_background_tasks = set()
+
+
+def _spawn(coro):
+    """イベント処理をasyncioタスクとして並行実行する"""
+    task = asyncio.create_task(_safe_handle(coro))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def _safe_handle(coro):
+    """イベント処理の例外を握りつぶさずログに残す"""
+    try:
+        await coro
+    except Exception as e:
+        logger.exception("Error handling LINE event: %s", e)
+
+# APIクライアントはプロセス生存期間中使い回す
+# （イベントごとに生成するとapi.line.meへのkeep-alive接続が破棄され、
+# 返信のたびにTLSハンドシェイクが発生する）
+_async_api_client = AsyncApiClient(configuration)
+_line_bot_api = AsyncMessagingApi(_async_api_client)
+
+
+@router.on_event("shutdown")
+async def _close_api_clients():
+    """プロセス終了時にAPIクライアントを閉じる"""
+    await _async_api_client.close()
+
+
+async def _reply_text(reply_token: str, text: str):
+    """非同期クライアントでテキストメッセージを返信する"""
+    await _line_bot_api.reply_message(
+        ReplyMessageRequest(
+            reply_token=reply_token,
+            messages=[TextMessage(text=text)],
+        )
+    )
+
+
+def _verify_signature(body: bytes, signature: str) -> bool:
+    """生のリクエストボディに対してHMAC-SHA256署名を検証する"""
+    mac = hmac.new(line_secret.encode('utf-8'), body, hashlib.sha256).digest()
+    return hmac.compare_digest(base64.b64encode(mac).decode('utf-8'), signature)
+
 
 @router.post("/webhook")
-async def callback(request: Request, background_tasks: BackgroundTasks):
+async def callback(request: Request):
     signature = request.headers.get('X-Line-Signature', '')
     body = await request.body()
-    body_decode = body.decode('utf-8')
-    
-    # デバッグ情報を出力
-    print(f"LINE Webhook received - Signature: {signature[:10]}...")
-    print(f"LINE_CHANNEL_SECRET: {line_secret[:5]}...")
-    print(f"Body length: {len(body_decode)} bytes")
-    
+
+    # デバッグ情報を出力（%スタイルでフォーマットを遅延させる）
+    logger.debug("LINE Webhook received - Signature: %.10s...", signature)
+    logger.debug("Body length: %d bytes", len(body))
+
+    # 署名をバイト列のまま検証し、無効ならデコード・解析を行わない
+    if not _verify_signature(body, signature):
+        logger.warning("Invalid signature error: signature mismatch")
+        # 署名エラーでも200を返す（LINEプラットフォームの要件）
+        return {"message": "OK"}
+
     try:
-        # イベントを解析して非同期処理
-        parser = WebhookParser(line_secret)
-        events = parser.parse(body_decode, signature)
-        print(f"Successfully parsed {len(events)} events")
+        # イベントを解析して非同期処理（署名検証済みのボディのみ到達する）
+        events = _parser.parse(body.decode('utf-8'), signature)
+        logger.debug("Successfully parsed %d events", len(events))
         for event in events:
             if isinstance(event, MessageEvent) and isinstance(event.message, TextMessageContent):
-                # バックグラウンドタスクとしてメッセージ処理を実行
-                background_tasks.add_task(process_message_async, event)
+                # asyncioタスクとして並行実行する
+                # （BackgroundTasksはレスポンス送信後に直列実行されるため、
+                # 複数イベントの返信が1件ずつになってしまう）
+                _spawn(process_message_async(event))
             elif isinstance(event, PostbackEvent):
                 # ポストバックイベントを処理
-                background_tasks.add_task(handle_postback, event)
+                _spawn(handle_postback(event))
     except InvalidSignatureError as e:
-        print(f"Invalid signature error: {e}")
+        logger.warning("Invalid signature error: %s", e)
         # 署名エラーでも200を返す（LINEプラットフォームの要件）
         return {"message": "OK"}
     except Exception as e:
-        print(f"Unexpected error in LINE webhook: {e}")
+        logger.exception("Unexpected error in LINE webhook: %s", e)
         # その他のエラーでも200を返す
         return {"message": "OK"}
-    
+
     # 即座に200 OKを返す
     return {"message": "OK"}
 
@@ -59,116 +159,110 @@ async def process_message_async(event):
     try:
         user_id = event.source.user_id
         user_message = event.message.text
-        
-        # ユーザーの認証状態を確認
-        is_authenticated = check_user_auth_status(user_id)
-        
-        if not is_authenticated and any(keyword in user_message for keyword in 
-                                       ["カレンダー", "予定", "会議", "ミーティング", "スケジュール"]):
-            auth_url = f"{os.getenv('APP_BASE_URL')}/google/authorize?user_id={user_id}"
+
+        # ユーザーの認証状態を確認（同期DBアクセスはスレッドに逃がす）
+        is_authenticated = await asyncio.to_thread(_check_user_auth_cached, user_id)
+
+        if not is_authenticated and _AUTH_KEYWORDS_RE.search(user_message) is not None:
+            auth_url = _AUTH_URL_TMPL.format(user_id)
             reply_text = (f"Googleカレンダーへのアクセス許可が必要です。"
                          f"以下のリンクから認証を行ってください。\n{auth_url}")
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                reply_message_request = ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=reply_text)]
-                )
-                line_bot_api.reply_message(reply_message_request)
+            await _reply_text(event.reply_token, reply_text)
         elif is_authenticated:
             # AIプロセッサを使用してメッセージを処理
-            response = process_user_message(user_id, user_message)
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                reply_message_request = ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=response)]
-                )
-                line_bot_api.reply_message(reply_message_request)
+            response = await aprocess_user_message(user_id, user_message)
+            await _reply_text(event.reply_token, response)
         else:
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                reply_message_request = ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text="こんにちは！カレンダーの予定を管理するには、"
-                                              "「予定」「スケジュール」などのキーワードを含むメッセージを送ってください。")]
-                )
-                line_bot_api.reply_message(reply_message_request)
+            await _reply_text(
+                event.reply_token,
+                "こんにちは！カレンダーの予定を管理するには、"
+                "「予定」「スケジュール」などのキーワードを含むメッセージを送ってください。",
+            )
     except Exception as e:
-        print(f"Error in async message processing: {e}")
+        logger.exception("Error in async message processing: %s", e)
         try:
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                reply_message_request = ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text="申し訳ありません。メッセージ処理中にエラーが発生しました。"
-                                              "後でもう一度お試しください。")]
-                )
-                line_bot_api.reply_message(reply_message_request)
+            await _reply_text(
+                event.reply_token,
+                "申し訳ありません。メッセージ処理中にエラーが発生しました。"
+                "後でもう一度お試しください。",
+            )
         except Exception:
             # リプライトークンの有効期限が切れている可能性がある
             pass
 
 
+async def _handle_vote_postback(user_id: str, event, parts: list):
+    """投票ポストバックを処理する"""
+    # 外部入力のため、ディスパッチ前に形式（v:<投票ID>:<選択肢番号>）を検証する
+    try:
+        if len(parts) != 3:
+            raise ValueError(f"expected 3 parts, got {len(parts)}")
+        option_index = int(parts[2])
+    except ValueError:
+        logger.warning("Malformed vote postback data: %s", event.postback.data)
+        await _reply_text(event.reply_token, "投票処理中にエラーが発生しました。")
+        return
+
+    event_title = await asyncio.to_thread(
+        process_vote,
+        user_id=user_id,
+        vote_id=parts[1],
+        option_index=option_index,
+    )
+
+    if event_title:
+        await _reply_text(event.reply_token, f"{event_title}の日程に投票しました。")
+    else:
+        await _reply_text(event.reply_token, "投票処理中にエラーが発生しました。")
+
+
+async def _handle_close_vote_postback(user_id: str, event, parts: list):
+    """投票締め切りポストバックを処理する"""
+    # 外部入力のため、ディスパッチ前に形式（c:<投票ID>）を検証する
+    if len(parts) != 2:
+        logger.warning("Malformed close postback data: %s", event.postback.data)
+        await _reply_text(event.reply_token, "投票締め切り処理中にエラーが発生しました。")
+        return
+
+    result = await asyncio.to_thread(close_voting, vote_id=parts[1])
+
+    if result:
+        event_title, announcement = result
+        # 結果通知と締め切り報告を1回のreply_messageにまとめる
+        # （LINE APIは1リクエストで最大5メッセージまで送信可能）
+        await _line_bot_api.reply_message(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[
+                    TextMessage(text=announcement),
+                    TextMessage(
+                        text=f"{event_title}の投票を締め切りました。最も多く投票された日時が選択されました。"
+                    ),
+                ],
+            )
+        )
+    else:
+        await _reply_text(event.reply_token, "投票締め切り処理中にエラーが発生しました。")
+
+
+# ポストバックのアクション名からハンドラへのディスパッチテーブル
+_POSTBACK_HANDLERS = {
+    "v": _handle_vote_postback,
+    "c": _handle_close_vote_postback,
+}
+
+
 async def handle_postback(event):
     """ポストバックイベントを処理する"""
     user_id = event.source.user_id
-    postback_data = event.postback.data
-
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-
-        if postback_data.startswith("vote_"):
-            parts = postback_data.split("_", 5)
-            if len(parts) >= 6:
-                _, group_id, event_title, option_index, start_time, end_time = parts
-
-                success = process_vote(
-                    user_id=user_id,
-                    group_id=group_id,
-                    event_title=event_title,
-                    option_index=int(option_index),
-                    start_time=start_time,
-                    end_time=end_time,
-                )
-
-                if success:
-                    line_bot_api.reply_message(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text=f"{event_title}の日程に投票しました。")],
-                        )
-                    )
-                else:
-                    line_bot_api.reply_message(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text="投票処理中にエラーが発生しました。")],
-                        )
-                    )
-
-        elif postback_data.startswith("close_vote_"):
-            parts = postback_data.split("_", 3)
-            if len(parts) >= 4:
-                _, _, group_id, event_title = parts
-
-                success = close_voting(group_id=group_id, event_title=event_title, line_bot_api=line_bot_api)
-
-                if success:
-                    line_bot_api.reply_message(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[
-                                TextMessage(
-                                    text=f"{event_title}の投票を締め切りました。最も多く投票された日時が選択されました。"
-                                )
-                            ],
-                        )
-                    )
-                else:
-                    line_bot_api.reply_message(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text="投票締め切り処理中にエラーが発生しました。")],
-                        )
-                    )
+
+    # ポストバックデータはコンパクトな不透明トークン形式
+    # （投票: v:<投票ID>:<選択肢番号> / 締め切り: c:<投票ID>）
+    # 選択肢の日時やタイトルはサーバー側の投票状態から引く
+    parts = event.postback.data.split(":")
+    handler = _POSTBACK_HANDLERS.get(parts[0])
+    if handler is None:
+        logger.warning("Unknown postback action: %s", event.postback.data)
+        return
+
+    await handler(user_id, event, parts)
@@ -1,4 +1,5 @@
 import datetime
+import re
 from typing import List, Dict, Any
 from langchain_core.tools import tool
 
@@ -9,6 +10,9 @@ from app.services.google_calendar import (
     delete_calendar_event
 )
 
+# 日本時間のタイムゾーン（呼び出しごとにtimedelta/timezoneを生成しない）
+_JST = datetime.timezone(datetime.timedelta(hours=9))
+
 
 @tool
 def create_event_tool(user_id: str, start_time: str, end_time: str, title: str, location: str = "", description: str = "") -> str:
@@ -151,32 +155,29 @@ def search_events_by_title_tool(user_id: str, title_keyword: str, start_time: st
     """
     # デフォルト値の設定
     if not start_time:
-        start_time = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=9))).replace(
+        start_time = datetime.datetime.now(_JST).replace(
             hour=0, minute=0, second=0, microsecond=0).isoformat()
     
     if not end_time:
         # 1週間後
-        end_time = (datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=9))) + 
+        end_time = (datetime.datetime.now(_JST) +
                    datetime.timedelta(days=7)).replace(
             hour=23, minute=59, second=59).isoformat()
     
-    # イベントを取得
-    events = get_calendar_events(user_id, start_time, end_time)
-    
-    # タイトルでフィルタリング
-    filtered_events = []
-    for event in events:
-        if title_keyword.lower() in event.get("summary", "").lower():
-            filtered_events.append({
-                "id": event.get("id", ""),
-                "summary": event.get("summary", "タイトルなし"),
-                "start": event.get("start", {}).get("dateTime", event.get("start", {}).get("date", "")),
-                "end": event.get("end", {}).get("dateTime", event.get("end", {}).get("date", "")),
-                "location": event.get("location", ""),
-                "description": event.get("description", "")
-            })
-    
-    return filtered_events
+    # qパラメータでAPI側に絞り込みを任せる（全件取得してのフィルタリングは不要）
+    events = get_calendar_events(user_id, start_time, end_time, query=title_keyword)
+
+    return [
+        {
+            "id": event.get("id", ""),
+            "summary": event.get("summary", "タイトルなし"),
+            "start": event.get("start", {}).get("dateTime", event.get("start", {}).get("date", "")),
+            "end": event.get("end", {}).get("dateTime", event.get("end", {}).get("date", "")),
+            "location": event.get("location", ""),
+            "description": event.get("description", "")
+        }
+        for event in events
+    ]
 
 
 @tool
@@ -187,58 +188,82 @@ def get_current_datetime_tool() -> str:
     Returns:
         現在の日本時間
     """
-    return datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=9))).isoformat()
+    return datetime.datetime.now(_JST).isoformat()
 
 
-@tool
-def parse_date_tool(date_string: str) -> str:
-    """
-    自然言語の日付文字列をISO形式 (RFC3339) の日付/時刻文字列に変換します。
-    
-    Args:
-        date_string: 変換する日付文字列 (例: '明日の午後3時', '来週の月曜日 10:00', '4月29日の0時')
-    
-    Returns:
-        ISO形式 (RFC3339) の日付/時刻文字列 (例: '2023-06-01T15:00:00+09:00')
-    """
+# 日付・時刻トークンを1回の線形スキャンで抽出する正規表現
+# （従来のif/elifラダーによる全文スキャンの繰り返しを避ける）
+_DATE_TOKEN_RE = re.compile(
+    r"(?P<month>\d+)月(?P<day>\d+)日"
+    r"|(?P<rel>今日|明日|明後日|昨日|今週|来週)"
+    r"|(?P<hour>\d+)時(?:(?P<minute>\d+)分)?"
+    r"|(?P<chour>\d+):(?P<cminute>\d{2})"
+    r"|(?P<ampm>午前|午後|朝|夕方|夜)"
+)
+
+# 来週の曜日指定の対応表（チェック順を維持するためタプルのリスト）
+_WEEKDAY_MAPPING = [
+    ("月曜", 0), ("月曜日", 0), ("月", 0),
+    ("火曜", 1), ("火曜日", 1), ("火", 1),
+    ("水曜", 2), ("水曜日", 2), ("水", 2),
+    ("木曜", 3), ("木曜日", 3), ("木", 3),
+    ("金曜", 4), ("金曜日", 4), ("金", 4),
+    ("土曜", 5), ("土曜日", 5), ("土", 5),
+    ("日曜", 6), ("日曜日", 6), ("日", 6),
+]
+
+
+def _parse_date_string(date_string: str) -> str:
+    """parse_date_tool / parse_dates_batch_tool 共通の日付解析処理"""
     try:
-        now = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=9)))
+        now = datetime.datetime.now(_JST)
         target_date = None
-        
-        # 特定の月日パターンを処理（例: 4月29日）
-        import re
-        month_day_pattern = re.compile(r'(\d+)月(\d+)日')
-        match = month_day_pattern.search(date_string)
-        
-        if match:
-            month = int(match.group(1))
-            day = int(match.group(2))
+
+        # 1回のスキャンでトークンを収集する
+        month = day = None
+        hour = minute = None
+        clock_hour = None
+        rel_tokens = set()
+        ampm_tokens = set()
+        for m in _DATE_TOKEN_RE.finditer(date_string):
+            if m.group("month"):
+                if month is None:
+                    month, day = int(m.group("month")), int(m.group("day"))
+            elif m.group("rel"):
+                rel_tokens.add(m.group("rel"))
+            elif m.group("hour"):
+                if hour is None:
+                    hour = int(m.group("hour"))
+                    minute = int(m.group("minute")) if m.group("minute") else 0
+            elif m.group("chour"):
+                if clock_hour is None:
+                    clock_hour = int(m.group("chour"))
+            else:
+                ampm_tokens.add(m.group("ampm"))
+
+        # 特定の月日指定を処理（例: 4月29日）
+        if month is not None:
             year = now.year
-            
+
             # 指定された月日が過去の場合は来年と判断
             if month < now.month or (month == now.month and day < now.day):
                 year += 1
-                
+
             try:
-                target_date = datetime.datetime(
-                    year=year, 
-                    month=month, 
-                    day=day,
-                    tzinfo=datetime.timezone(datetime.timedelta(hours=9))
-                )
+                target_date = datetime.datetime(year=year, month=month, day=day, tzinfo=_JST)
             except ValueError as e:
                 return f"無効な日付です: {month}月{day}日 - {str(e)}"
-        
+
         # 「今日」「明日」などの相対的な日付を処理
-        elif "今日" in date_string:
+        elif "今日" in rel_tokens:
             target_date = now
-        elif "明日" in date_string:
+        elif "明日" in rel_tokens:
             target_date = now + datetime.timedelta(days=1)
-        elif "明後日" in date_string:
+        elif "明後日" in rel_tokens:
             target_date = now + datetime.timedelta(days=2)
-        elif "昨日" in date_string:
+        elif "昨日" in rel_tokens:
             target_date = now - datetime.timedelta(days=1)
-        elif "今週" in date_string:
+        elif "今週" in rel_tokens:
             # 今週の月曜日から日曜日
             weekday = now.weekday()
             start_date = now - datetime.timedelta(days=weekday)
@@ -247,34 +272,24 @@ def parse_date_tool(date_string: str) -> str:
                 "start_date": start_date.replace(hour=0, minute=0, second=0).isoformat(),
                 "end_date": end_date.replace(hour=23, minute=59, second=59).isoformat()
             }
-        elif "来週" in date_string:
+        elif "来週" in rel_tokens:
             # 来週の特定の曜日を処理
-            weekday_mapping = {
-                "月曜": 0, "月曜日": 0, "月": 0,
-                "火曜": 1, "火曜日": 1, "火": 1,
-                "水曜": 2, "水曜日": 2, "水": 2,
-                "木曜": 3, "木曜日": 3, "木": 3,
-                "金曜": 4, "金曜日": 4, "金": 4,
-                "土曜": 5, "土曜日": 5, "土": 5,
-                "日曜": 6, "日曜日": 6, "日": 6
-            }
-            
             target_weekday = None
-            for day_name, day_num in weekday_mapping.items():
+            for day_name, day_num in _WEEKDAY_MAPPING:
                 if day_name in date_string:
                     target_weekday = day_num
                     break
-            
+
             if target_weekday is not None:
                 # 今日の曜日から目標の曜日までの日数を計算
                 current_weekday = now.weekday()
                 days_until_target = 7 - current_weekday + target_weekday
                 if days_until_target >= 7:
                     days_until_target -= 7
-                
+
                 # 来週なので7日追加
                 days_until_target += 7
-                
+
                 target_date = now + datetime.timedelta(days=days_until_target)
             else:
                 # 特定の曜日が指定されていない場合は、来週の月曜日から日曜日の範囲を返す
@@ -287,43 +302,55 @@ def parse_date_tool(date_string: str) -> str:
                 }
         else:
             # デフォルトは今日
-            if target_date is None:
-                target_date = now
-        
-        # 時間の処理
-        # 特定の時間パターンを処理（例: 0時、12時、15時30分）
-        time_pattern = re.compile(r'(\d+)時(?:(\d+)分)?')
-        time_match = time_pattern.search(date_string)
-        
-        if time_match:
-            hour = int(time_match.group(1))
-            minute = int(time_match.group(2)) if time_match.group(2) else 0
+            target_date = now
+
+        # 時間の処理（例: 0時、12時、15時30分）
+        if hour is not None:
             target_date = target_date.replace(hour=hour, minute=minute, second=0)
-        elif "午前" in date_string or "朝" in date_string:
-            if "9時" in date_string or "9:00" in date_string:
-                target_date = target_date.replace(hour=9, minute=0, second=0)
-            elif "10時" in date_string or "10:00" in date_string:
-                target_date = target_date.replace(hour=10, minute=0, second=0)
-            elif "11時" in date_string or "11:00" in date_string:
-                target_date = target_date.replace(hour=11, minute=0, second=0)
+        elif "午前" in ampm_tokens or "朝" in ampm_tokens:
+            if clock_hour in (9, 10, 11):
+                target_date = target_date.replace(hour=clock_hour, minute=0, second=0)
             else:
                 target_date = target_date.replace(hour=9, minute=0, second=0)
-        elif "午後" in date_string or "夕方" in date_string or "夜" in date_string:
-            if "3時" in date_string or "15:00" in date_string or "15時" in date_string:
-                target_date = target_date.replace(hour=15, minute=0, second=0)
-            elif "6時" in date_string or "18:00" in date_string or "18時" in date_string:
-                target_date = target_date.replace(hour=18, minute=0, second=0)
-            elif "7時" in date_string or "19:00" in date_string or "19時" in date_string:
-                target_date = target_date.replace(hour=19, minute=0, second=0)
-            elif "8時" in date_string or "20:00" in date_string or "20時" in date_string:
-                target_date = target_date.replace(hour=20, minute=0, second=0)
+        elif ampm_tokens & {"午後", "夕方", "夜"}:
+            if clock_hour in (15, 18, 19, 20):
+                target_date = target_date.replace(hour=clock_hour, minute=0, second=0)
             else:
                 target_date = target_date.replace(hour=15, minute=0, second=0)
         else:
             # デフォルトは午後3時（ただし、時間が既に設定されている場合は変更しない）
             if "時" not in date_string and ":" not in date_string:
                 target_date = target_date.replace(hour=15, minute=0, second=0)
-        
+
         return target_date.isoformat()
     except Exception as e:
         return f"日付の解析に失敗しました: {str(e)}"
+
+
+@tool
+def parse_date_tool(date_string: str) -> str:
+    """
+    自然言語の日付文字列をISO形式 (RFC3339) の日付/時刻文字列に変換します。
+
+    Args:
+        date_string: 変換する日付文字列 (例: '明日の午後3時', '来週の月曜日 10:00', '4月29日の0時')
+
+    Returns:
+        ISO形式 (RFC3339) の日付/時刻文字列 (例: '2023-06-01T15:00:00+09:00')
+    """
+    return _parse_date_string(date_string)
+
+
+@tool
+def parse_dates_batch_tool(date_strings: List[str]) -> List[str]:
+    """
+    複数の自然言語の日付文字列をまとめてISO形式 (RFC3339) に変換します。
+    複数の日付を扱う場合は、parse_dateを繰り返し呼ぶ代わりにこちらを1回呼んでください。
+
+    Args:
+        date_strings: 変換する日付文字列のリスト (例: ['明日の午後3時', '来週の月曜日 10:00'])
+
+    Returns:
+        入力と同じ順序のISO形式 (RFC3339) の日付/時刻文字列のリスト
+    """
+    return [_parse_date_string(date_string) for date_string in date_strings]
@@ -2,16 +2,39 @@
 データベース接続と認証情報の管理を行うモジュール
 """
 
-import os
 import json
+import logging
+import os
 import sqlite3
+import threading
 from typing import Dict, Any, Optional
 
+logger = logging.getLogger(__name__)
+
 
 class DatabaseManager:
     """データベース接続と操作を管理するクラス"""
-    
+
     _instance = None
+
+    # SQLはクラス定数として1回だけ定義する
+    # （文字列が安定していればsqlite3のステートメントキャッシュが効く）
+    _UPSERT_SQL = (
+        "INSERT INTO user_tokens ("
+        "user_id, token, refresh_token, token_uri, client_id, client_secret, scopes"
+        ") VALUES (?, ?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT(user_id) DO UPDATE SET "
+        "token=excluded.token, refresh_token=excluded.refresh_token, "
+        "token_uri=excluded.token_uri, client_id=excluded.client_id, "
+        "client_secret=excluded.client_secret, scopes=excluded.scopes"
+    )
+
+    _SELECT_SQL = (
+        "SELECT token, refresh_token, token_uri, client_id, client_secret, scopes "
+        "FROM user_tokens WHERE user_id = ?"
+    )
+
+    _EXISTS_SQL = "SELECT 1 FROM user_tokens WHERE user_id = ?"
     
     def __new__(cls):
         """シングルトンパターンを実装"""
@@ -24,10 +47,14 @@ class DatabaseManager:
         """データベース接続を初期化"""
         base_dir = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
         self.db_path = os.getenv("SQLITE_DB_PATH", os.path.join(base_dir, "user_tokens.db"))
-        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
-        
+
+        # スレッドごとに接続を保持する
+        # （単一接続の共有はSQLite内部のミューテックスで直列化されるため）
+        self._local = threading.local()
+
         # テーブルの作成
-        self.conn.execute("""
+        conn = self._get_conn()
+        conn.execute("""
         CREATE TABLE IF NOT EXISTS user_tokens (
             user_id TEXT PRIMARY KEY,
             token TEXT,
@@ -38,56 +65,74 @@ class DatabaseManager:
             scopes TEXT
         )
         """)
-        self.conn.commit()
-    
+        conn.commit()
+
+    def _get_conn(self) -> sqlite3.Connection:
+        """現在のスレッド用のデータベース接続を取得する（なければ作成）"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, cached_statements=256)
+            # WALモードで読み取りが書き込みをブロックしないようにする
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """後方互換性のための接続プロパティ"""
+        return self._get_conn()
+
+    @staticmethod
+    def _to_row(user_id: str, token_info: Dict[str, Any]) -> tuple:
+        """トークン情報をINSERT用の行タプルに変換する"""
+        return (
+            user_id,
+            token_info.get("token"),
+            token_info.get("refresh_token"),
+            token_info.get("token_uri"),
+            token_info.get("client_id"),
+            token_info.get("client_secret"),
+            json.dumps(token_info.get("scopes", [])),
+        )
+
     def save_user_tokens(self, user_id: str, token_info: Dict[str, Any]) -> bool:
         """ユーザーのトークン情報を保存する"""
         try:
-            scopes_str = json.dumps(token_info.get("scopes", []))
-            self.conn.execute(
-                """
-                INSERT INTO user_tokens (
-                    user_id, token, refresh_token, token_uri, 
-                    client_id, client_secret, scopes
-                )
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-                ON CONFLICT(user_id) DO UPDATE SET
-                    token=excluded.token,
-                    refresh_token=excluded.refresh_token,
-                    token_uri=excluded.token_uri,
-                    client_id=excluded.client_id,
-                    client_secret=excluded.client_secret,
-                    scopes=excluded.scopes
-                """,
-                (
-                    user_id,
-                    token_info.get("token"),
-                    token_info.get("refresh_token"),
-                    token_info.get("token_uri"),
-                    token_info.get("client_id"),
-                    token_info.get("client_secret"),
-                    scopes_str
-                )
+            conn = self._get_conn()
+            conn.execute(self._UPSERT_SQL, self._to_row(user_id, token_info))
+            conn.commit()
+            return True
+        except Exception as e:
+            logger.error("Error saving user tokens: %s", e)
+            return False
+
+    def save_user_tokens_bulk(self, items: Dict[str, Dict[str, Any]]) -> bool:
+        """複数ユーザーのトークン情報を一括保存する（一括リフレッシュ用）"""
+        try:
+            conn = self._get_conn()
+            conn.executemany(
+                self._UPSERT_SQL,
+                [self._to_row(user_id, info) for user_id, info in items.items()],
             )
-            self.conn.commit()
+            conn.commit()
             return True
         except Exception as e:
-            print(f"Error saving user tokens: {e}")
+            logger.error("Error bulk saving user tokens: %s", e)
             return False
-    
+
+    def user_has_tokens(self, user_id: str) -> bool:
+        """ユーザーのトークンが存在するかだけを確認する"""
+        try:
+            return self._get_conn().execute(self._EXISTS_SQL, (user_id,)).fetchone() is not None
+        except Exception as e:
+            logger.error("Error checking user tokens: %s", e)
+            return False
+
     def get_user_tokens(self, user_id: str) -> Optional[Dict[str, Any]]:
         """ユーザーのトークン情報を取得する"""
         try:
-            row = self.conn.execute(
-                """
-                SELECT 
-                    token, refresh_token, token_uri, 
-                    client_id, client_secret, scopes 
-                FROM user_tokens 
-                WHERE user_id = ?
-                """,
-                (user_id,)
-            ).fetchone()
+            row = self._get_conn().execute(self._SELECT_SQL, (user_id,)).fetchone()
             
             if not row:
                 return None
@@ -102,7 +147,7 @@ class DatabaseManager:
                 "scopes": scopes
             }
         except Exception as e:
-            print(f"Error getting user tokens: {e}")
+            logger.error("Error getting user tokens: %s", e)
             return None
 
 
@@ -3,13 +3,47 @@
 環境変数に基づいて適切なデータベース実装を選択します
 """
 
+import asyncio
+import logging
 import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from typing import Dict, Any, Optional
 
+from cachetools import TTLCache
+
 # データベース実装のインポート
 from app.services.database import DatabaseManager as SQLiteDatabaseManager
 from app.services.firebase_database import FirebaseDatabaseManager
 
+logger = logging.getLogger(__name__)
+
+# トークン読み取りの短期キャッシュ
+# （1ターン中に認証チェック・サービス構築などで同じトークンを何度も
+#   読みに行くため、バックエンドへの往復を数分単位でまとめる）
+_tokens_cache: TTLCache = TTLCache(maxsize=10_000, ttl=300)
+_tokens_cache_lock = threading.Lock()
+
+# データベースI/Oを並列化するための共有スレッドプール
+# （複数ユーザー分の書き込みを直列に待たずにオーバーラップさせる）
+_pool = ThreadPoolExecutor(max_workers=20, thread_name_prefix="db-io")
+
+# 同一ユーザーへの同時キャッシュミスを1回の読み取りにまとめるための
+# 実行中リクエストのマップ（singleflight）
+_inflight_reads: Dict[str, Future] = {}
+
+# グループスケジュールのクエリ結果キャッシュ
+# （通知の描画・投票状況の確認などで同じグループを連続照会するため）
+_group_schedule_cache: TTLCache = TTLCache(maxsize=1_000, ttl=30)
+
+# 投票操作（event_id単位）から無効化対象のグループを逆引きするマップ
+_event_to_group: TTLCache = TTLCache(maxsize=10_000, ttl=86_400)
+
+# 上記2つのキャッシュはdb-ioプールとto_threadワーカーの両方から触られるが
+# TTLCacheはスレッドセーフではないため、_tokens_cacheと同様にロックで守る
+# （常にペアで更新するので1つのロックで兼ねる）
+_group_schedule_cache_lock = threading.Lock()
+
 
 class DatabaseFactory:
     """
@@ -41,11 +75,125 @@ db_manager = DatabaseFactory.get_database_manager()
 # 外部から使用するための関数
 def save_user_tokens(user_id: str, token_info: Dict[str, Any]) -> bool:
     """ユーザーのトークン情報を保存する"""
-    return db_manager.save_user_tokens(user_id, token_info)
+    result = db_manager.save_user_tokens(user_id, token_info)
+    if result:
+        # 古いトークンを返さないよう、保存成功時はキャッシュを破棄する
+        with _tokens_cache_lock:
+            _tokens_cache.pop(user_id, None)
+    return result
 
 def get_user_tokens(user_id: str) -> Optional[Dict[str, Any]]:
-    """ユーザーのトークン情報を取得する"""
-    return db_manager.get_user_tokens(user_id)
+    """
+    ユーザーのトークン情報を取得する（短期キャッシュ付き）
+
+    バースト時に同一ユーザーへのキャッシュミスが同時に発生しても、
+    バックエンドへの読み取りは1回にまとめ、他の呼び出しはその結果を待つ。
+    """
+    with _tokens_cache_lock:
+        cached = _tokens_cache.get(user_id)
+        if cached is not None:
+            return cached
+
+        future = _inflight_reads.get(user_id)
+        if future is None:
+            future = Future()
+            _inflight_reads[user_id] = future
+            is_owner = True
+        else:
+            is_owner = False
+
+    if not is_owner:
+        # 別スレッドが実行中の読み取り結果を共有する
+        return future.result()
+
+    try:
+        tokens = db_manager.get_user_tokens(user_id)
+        if tokens is not None:
+            with _tokens_cache_lock:
+                _tokens_cache[user_id] = tokens
+        future.set_result(tokens)
+        return tokens
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _tokens_cache_lock:
+            _inflight_reads.pop(user_id, None)
+
+def user_has_tokens(user_id: str) -> bool:
+    """
+    ユーザーのトークンが存在するかだけを確認する
+
+    認証チェック用の軽量版。トークンがキャッシュ済みならバックエンドに
+    アクセスせず、未キャッシュでも存在確認のみの軽いクエリで済ませる。
+    """
+    with _tokens_cache_lock:
+        if user_id in _tokens_cache:
+            return True
+    return db_manager.user_has_tokens(user_id)
+
+def save_user_tokens_async(user_id: str, token_info: Dict[str, Any]) -> Future:
+    """ユーザーのトークン情報を共有スレッドプールで非同期に保存する"""
+    return _pool.submit(save_user_tokens, user_id, token_info)
+
+def save_group_schedule_async(group_id: str, event_data: Dict[str, Any]) -> Future:
+    """グループスケジュールデータを共有スレッドプールで非同期に保存する"""
+    return _pool.submit(save_group_schedule, group_id, event_data)
+
+def bulk_save_group_schedules(items: list) -> bool:
+    """
+    複数のグループスケジュールを並列に保存する
+
+    Args:
+        items: (group_id, event_data) のタプルのリスト
+
+    Returns:
+        すべての保存が成功した場合はTrue
+    """
+    futures = [_pool.submit(save_group_schedule, group_id, event_data) for group_id, event_data in items]
+    return all(future.result() for future in as_completed(futures))
+
+# asyncコード（Webhookハンドラなど）から直接awaitできる非同期ファサード
+# （イベントループをブロックせず、実行はスレッドプールに逃がす）
+async def aget_user_tokens(user_id: str) -> Optional[Dict[str, Any]]:
+    """ユーザーのトークン情報を非同期に取得する"""
+    return await asyncio.to_thread(get_user_tokens, user_id)
+
+async def asave_user_tokens(user_id: str, token_info: Dict[str, Any]) -> bool:
+    """ユーザーのトークン情報を非同期に保存する"""
+    return await asyncio.to_thread(save_user_tokens, user_id, token_info)
+
+async def aget_group_schedules(group_id: str) -> list:
+    """グループのスケジュールを非同期に取得する"""
+    return await asyncio.to_thread(get_group_schedules, group_id)
+
+async def asave_group_schedule(group_id: str, event_data: Dict[str, Any]) -> bool:
+    """グループスケジュールデータを非同期に保存する"""
+    return await asyncio.to_thread(save_group_schedule, group_id, event_data)
+
+async def aupdate_vote(event_id: str, user_id: str, date_option: str, vote: bool) -> bool:
+    """日程投票を非同期に更新する"""
+    return await asyncio.to_thread(update_vote, event_id, user_id, date_option, vote)
+
+# 会話履歴の永続化（Firebaseのみサポート）
+# ワーカーの再起動や水平スケールでプロセス内メモリが失われても
+# 会話が途切れないようにするためのベストエフォートな保存で、
+# SQLite構成では黙ってスキップする
+def save_conversation(user_id: str, messages: list) -> bool:
+    """ユーザーの会話履歴を保存する"""
+    if isinstance(db_manager, FirebaseDatabaseManager):
+        return db_manager.save_conversation(user_id, messages)
+    return False
+
+def get_conversation(user_id: str) -> list:
+    """ユーザーの会話履歴を取得する"""
+    if isinstance(db_manager, FirebaseDatabaseManager):
+        return db_manager.get_conversation(user_id)
+    return []
+
+def save_conversation_async(user_id: str, messages: list) -> Future:
+    """ユーザーの会話履歴を共有スレッドプールで非同期に保存する"""
+    return _pool.submit(save_conversation, user_id, messages)
 
 # グループスケジュール関連の関数（Firebaseのみサポート）
 def save_group_schedule(group_id: str, event_data: Dict[str, Any]) -> bool:
@@ -56,9 +204,16 @@ def save_group_schedule(group_id: str, event_data: Dict[str, Any]) -> bool:
         この機能はFirebaseデータベースでのみサポートされています
     """
     if isinstance(db_manager, FirebaseDatabaseManager):
-        return db_manager.save_group_schedule(group_id, event_data)
+        result = db_manager.save_group_schedule(group_id, event_data)
+        if result:
+            with _group_schedule_cache_lock:
+                _group_schedule_cache.pop(group_id, None)
+                event_id = event_data.get("event_id")
+                if event_id:
+                    _event_to_group[event_id] = group_id
+        return result
     else:
-        print("Warning: グループスケジュール機能はFirebaseデータベースでのみサポートされています")
+        logger.warning("グループスケジュール機能はFirebaseデータベースでのみサポートされています")
         return False
 
 def get_group_schedules(group_id: str) -> list:
@@ -69,9 +224,22 @@ def get_group_schedules(group_id: str) -> list:
         この機能はFirebaseデータベースでのみサポートされています
     """
     if isinstance(db_manager, FirebaseDatabaseManager):
-        return db_manager.get_group_schedules(group_id)
+        with _group_schedule_cache_lock:
+            cached = _group_schedule_cache.get(group_id)
+        if cached is not None:
+            return cached
+
+        events = db_manager.get_group_schedules(group_id)
+        with _group_schedule_cache_lock:
+            _group_schedule_cache[group_id] = events
+            # 投票操作からの無効化用にevent_id→group_idを記録しておく
+            for event in events:
+                event_id = event.get("event_id")
+                if event_id:
+                    _event_to_group[event_id] = group_id
+        return events
     else:
-        print("Warning: グループスケジュール機能はFirebaseデータベースでのみサポートされています")
+        logger.warning("グループスケジュール機能はFirebaseデータベースでのみサポートされています")
         return []
 
 def update_vote(event_id: str, user_id: str, date_option: str, vote: bool) -> bool:
@@ -82,9 +250,15 @@ def update_vote(event_id: str, user_id: str, date_option: str, vote: bool) -> bo
         この機能はFirebaseデータベースでのみサポートされています
     """
     if isinstance(db_manager, FirebaseDatabaseManager):
-        return db_manager.update_vote(event_id, user_id, date_option, vote)
+        result = db_manager.update_vote(event_id, user_id, date_option, vote)
+        if result:
+            with _group_schedule_cache_lock:
+                group_id = _event_to_group.get(event_id)
+                if group_id:
+                    _group_schedule_cache.pop(group_id, None)
+        return result
     else:
-        print("Warning: 投票機能はFirebaseデータベースでのみサポートされています")
+        logger.warning("投票機能はFirebaseデータベースでのみサポートされています")
         return False
 
 def close_vote(event_id: str, selected_date: str) -> bool:
@@ -95,7 +269,13 @@ def close_vote(event_id: str, selected_date: str) -> bool:
         この機能はFirebaseデータベースでのみサポートされています
     """
     if isinstance(db_manager, FirebaseDatabaseManager):
-        return db_manager.close_vote(event_id, selected_date)
+        result = db_manager.close_vote(event_id, selected_date)
+        if result:
+            with _group_schedule_cache_lock:
+                group_id = _event_to_group.get(event_id)
+                if group_id:
+                    _group_schedule_cache.pop(group_id, None)
+        return result
     else:
-        print("Warning: 投票締め切り機能はFirebaseデータベースでのみサポートされています")
+        logger.warning("投票締め切り機能はFirebaseデータベースでのみサポートされています")
         return False
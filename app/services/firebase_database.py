@@ -2,11 +2,44 @@
 Firebase Firestoreを使用したデータベース接続と認証情報の管理を行うモジュール
 """
 
-import os
 import json
+import logging
+import os
 from typing import Dict, Any, Optional
 import firebase_admin
 from firebase_admin import credentials, firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+from google.cloud.firestore_v1.field_path import FieldPath
+
+logger = logging.getLogger(__name__)
+
+
+def _load_certificate():
+    """環境変数からFirebase認証情報を読み込んでCertificateを構築する"""
+    # 方法1: 環境変数から直接JSON文字列を読み取る
+    if "FIREBASE_CREDENTIALS" in os.environ:
+        try:
+            cred_dict = json.loads(os.environ["FIREBASE_CREDENTIALS"])
+            cred = credentials.Certificate(cred_dict)
+            logger.info("環境変数から直接Firebase認証情報を読み込みました")
+            return cred
+        except Exception as e:
+            logger.error("環境変数からの認証情報読み込みに失敗しました: %s", e)
+
+    # 方法2: 環境変数からファイルパスを読み取る
+    if "FIREBASE_CREDENTIALS_PATH" in os.environ:
+        cred_path = os.environ["FIREBASE_CREDENTIALS_PATH"]
+        if os.path.exists(cred_path):
+            logger.info("ファイルからFirebase認証情報を読み込みました: %s", cred_path)
+            return credentials.Certificate(cred_path)
+        raise ValueError(f"指定されたパスに認証情報ファイルが見つかりません: {cred_path}")
+
+    return None
+
+
+# 認証情報のJSON解析とRSA鍵の読み込みはモジュールインポート時に1回だけ行う。
+# gunicorn等で--preloadを使えばマスタープロセスで構築され、fork先のワーカーで共有される。
+_CERT = _load_certificate()
 
 
 class FirebaseDatabaseManager:
@@ -25,33 +58,12 @@ class FirebaseDatabaseManager:
         """Firestore接続を初期化"""
         # Firebase初期化（まだ初期化されていない場合）
         if not firebase_admin._apps:
-            # 環境変数から認証情報を取得する方法を決定
-            cred = None
-
-            # 方法1: 環境変数から直接JSON文字列を読み取る
-            if "FIREBASE_CREDENTIALS" in os.environ:
-                try:
-                    cred_dict = json.loads(os.environ["FIREBASE_CREDENTIALS"])
-                    cred = credentials.Certificate(cred_dict)
-                    print("環境変数から直接Firebase認証情報を読み込みました")
-                except Exception as e:
-                    print(f"環境変数からの認証情報読み込みに失敗しました: {e}")
-
-            # 方法2: 環境変数からファイルパスを読み取る
-            if cred is None and "FIREBASE_CREDENTIALS_PATH" in os.environ:
-                cred_path = os.environ["FIREBASE_CREDENTIALS_PATH"]
-                if os.path.exists(cred_path):
-                    cred = credentials.Certificate(cred_path)
-                    print(f"ファイルからFirebase認証情報を読み込みました: {cred_path}")
-                else:
-                    raise ValueError(f"指定されたパスに認証情報ファイルが見つかりません: {cred_path}")
-
-            # どちらの方法でも認証情報が取得できなかった場合
-            if cred is None:
+            # 認証情報はモジュールインポート時に解析済みのものを使う
+            if _CERT is None:
                 raise ValueError("FIREBASE_CREDENTIALS または FIREBASE_CREDENTIALS_PATH が設定されていません")
 
             # Firebaseアプリを初期化
-            firebase_admin.initialize_app(cred)
+            firebase_admin.initialize_app(_CERT)
 
         # Firestoreクライアントを取得
         self.db = firestore.client()
@@ -84,9 +96,43 @@ class FirebaseDatabaseManager:
             return True
 
         except Exception as e:
-            print(f"Firestoreにトークン情報を保存中にエラーが発生しました: {e}")
+            logger.error("Firestoreにトークン情報を保存中にエラーが発生しました: %s", e)
             return False
 
+    def save_user_tokens_bulk(self, items: list) -> int:
+        """
+        複数ユーザーのトークン情報を1回のバッチ書き込みで保存する
+
+        1件ずつのsave_user_tokensはユーザー数分のRPC往復になるため、
+        移行処理などの一括保存ではこちらを使う。Firestoreのバッチ上限は
+        500件のため、呼び出し側で500件以下に分割して渡すこと。
+
+        Args:
+            items: (user_id, token_info) のタプルのリスト
+
+        Returns:
+            保存した件数（失敗した場合は0）
+        """
+        try:
+            batch = self.db.batch()
+            for user_id, token_info in items:
+                data = {
+                    "token": token_info.get("token"),
+                    "refresh_token": token_info.get("refresh_token"),
+                    "token_uri": token_info.get("token_uri"),
+                    "client_id": token_info.get("client_id"),
+                    "client_secret": token_info.get("client_secret"),
+                    "scopes": token_info.get("scopes", []),
+                    "updated_at": firestore.SERVER_TIMESTAMP,
+                }
+                batch.set(self.db.collection("user_tokens").document(user_id), data)
+            batch.commit()
+            return len(items)
+
+        except Exception as e:
+            logger.error("Firestoreへのトークン情報の一括保存中にエラーが発生しました: %s", e)
+            return 0
+
     def get_user_tokens(self, user_id: str) -> Optional[Dict[str, Any]]:
         """
         ユーザーのトークン情報をFirestoreから取得する
@@ -119,9 +165,29 @@ class FirebaseDatabaseManager:
             }
 
         except Exception as e:
-            print(f"Firestoreからトークン情報を取得中にエラーが発生しました: {e}")
+            logger.error("Firestoreからトークン情報を取得中にエラーが発生しました: %s", e)
             return None
 
+    def user_has_tokens(self, user_id: str) -> bool:
+        """
+        ユーザーのトークンが存在するかだけを確認する
+
+        field_pathsで1フィールドに絞った存在確認なので、
+        トークン全体を転送するget_user_tokensより軽い。
+
+        Args:
+            user_id: ユーザーID
+
+        Returns:
+            トークンが存在する場合はTrue
+        """
+        try:
+            doc = self.db.collection("user_tokens").document(user_id).get(field_paths=["token"])
+            return doc.exists
+        except Exception as e:
+            logger.error("Firestoreでトークン存在確認中にエラーが発生しました: %s", e)
+            return False
+
     def save_group_schedule(self, group_id: str, event_data: Dict[str, Any]) -> bool:
         """
         グループスケジュールデータを保存する
@@ -140,18 +206,22 @@ class FirebaseDatabaseManager:
             event_id = event_data.get("event_id", self.db.collection("group_events").document().id)
             event_data["event_id"] = event_id
 
-            # ドキュメントを更新または作成
-            self.db.collection("group_events").document(event_id).set(event_data)
+            # group_idを本体に持たせ、取得時にwhereクエリ1回で引けるようにする
+            event_data["group_id"] = group_id
 
-            # グループとイベントの関連付け
-            self.db.collection("groups").document(group_id).collection("events").document(event_id).set(
-                {"event_id": event_id, "created_at": firestore.SERVER_TIMESTAMP}
+            # イベント本体とグループとの関連付けを1回のRPCでアトミックにコミットする
+            batch = self.db.batch()
+            batch.set(self.db.collection("group_events").document(event_id), event_data)
+            batch.set(
+                self.db.collection("groups").document(group_id).collection("events").document(event_id),
+                {"event_id": event_id, "created_at": firestore.SERVER_TIMESTAMP},
             )
+            batch.commit()
 
             return True
 
         except Exception as e:
-            print(f"グループスケジュールデータの保存中にエラーが発生しました: {e}")
+            logger.error("グループスケジュールデータの保存中にエラーが発生しました: %s", e)
             return False
 
     def get_group_schedules(self, group_id: str) -> list:
@@ -165,21 +235,78 @@ class FirebaseDatabaseManager:
             スケジュールのリスト
         """
         try:
-            # グループに関連するイベントIDを取得
-            event_refs = self.db.collection("groups").document(group_id).collection("events").stream()
+            # イベント本体がgroup_idを持っているので、whereクエリ1回で取得できる
+            # （関連付けサブコレクションを経由した2段階の読み取りは不要）
+            docs = (
+                self.db.collection("group_events")
+                .where(filter=FieldFilter("group_id", "==", group_id))
+                .stream()
+            )
+            events = [doc.to_dict() for doc in docs]
+
+            if events:
+                return events
+
+            # 過去に保存されたgroup_idフィールドを持たないイベントのフォールバック:
+            # サブコレクションからIDを引き、1回のget_allでまとめて取得する
+            event_refs = (
+                self.db.collection("groups")
+                .document(group_id)
+                .collection("events")
+                .select(["event_id"])
+                .stream()
+            )
             event_ids = [event_ref.to_dict().get("event_id") for event_ref in event_refs]
 
-            # 各イベントの詳細を取得
-            events = []
-            for event_id in event_ids:
-                doc = self.db.collection("group_events").document(event_id).get()
-                if doc.exists:
-                    events.append(doc.to_dict())
+            refs = [self.db.collection("group_events").document(eid) for eid in event_ids if eid]
+            if not refs:
+                return []
 
-            return events
+            return [doc.to_dict() for doc in self.db.get_all(refs) if doc.exists]
 
         except Exception as e:
-            print(f"グループスケジュールの取得中にエラーが発生しました: {e}")
+            logger.error("グループスケジュールの取得中にエラーが発生しました: %s", e)
+            return []
+
+    def save_conversation(self, user_id: str, messages: list) -> bool:
+        """
+        ユーザーの会話履歴を保存する（全体を上書き）
+
+        Args:
+            user_id: ユーザーID
+            messages: {"role": ..., "content": ...} 形式のメッセージのリスト
+
+        Returns:
+            保存が成功した場合はTrue、失敗した場合はFalse
+        """
+        try:
+            self.db.collection("conversations").document(user_id).set(
+                {"messages": messages, "updated_at": firestore.SERVER_TIMESTAMP}
+            )
+            return True
+
+        except Exception as e:
+            logger.error("会話履歴の保存中にエラーが発生しました: %s", e)
+            return False
+
+    def get_conversation(self, user_id: str) -> list:
+        """
+        ユーザーの会話履歴を取得する
+
+        Args:
+            user_id: ユーザーID
+
+        Returns:
+            メッセージのリスト、存在しない場合は空リスト
+        """
+        try:
+            doc = self.db.collection("conversations").document(user_id).get()
+            if not doc.exists:
+                return []
+            return doc.to_dict().get("messages", [])
+
+        except Exception as e:
+            logger.error("会話履歴の取得中にエラーが発生しました: %s", e)
             return []
 
     def update_vote(self, event_id: str, user_id: str, date_option: str, vote: bool) -> bool:
@@ -196,31 +323,20 @@ class FirebaseDatabaseManager:
             更新が成功した場合はTrue、失敗した場合はFalse
         """
         try:
-            # トランザクションを使用して安全に更新
-            transaction = self.db.transaction()
-            event_ref = self.db.collection("group_events").document(event_id)
-
-            @firestore.transactional
-            def update_in_transaction(transaction, event_ref):
-                event = event_ref.get(transaction=transaction).to_dict()
-
-                # 投票データがなければ初期化
-                if "votes" not in event:
-                    event["votes"] = {}
-                if date_option not in event["votes"]:
-                    event["votes"][date_option] = {}
-
-                # 投票を更新
-                event["votes"][date_option][user_id] = vote
-
-                # 更新をコミット
-                transaction.update(event_ref, {"votes": event["votes"]})
-                return True
-
-            return update_in_transaction(transaction, event_ref)
+            # フィールドパス指定で該当の1票だけを直接書き込む。
+            # updateは存在しない中間マップを自動生成し、異なるユーザー・日程への
+            # 同時投票は別フィールドの更新なので競合しない。
+            # （ドキュメント全体を読み書きするトランザクションは不要）
+            self.db.collection("group_events").document(event_id).update(
+                {
+                    FieldPath("votes", date_option, user_id): vote,
+                    "updated_at": firestore.SERVER_TIMESTAMP,
+                }
+            )
+            return True
 
         except Exception as e:
-            print(f"投票の更新中にエラーが発生しました: {e}")
+            logger.error("投票の更新中にエラーが発生しました: %s", e)
             return False
 
     def close_vote(self, event_id: str, selected_date: str) -> bool:
@@ -245,7 +361,7 @@ class FirebaseDatabaseManager:
             return True
 
         except Exception as e:
-            print(f"投票締め切り処理中にエラーが発生しました: {e}")
+            logger.error("投票締め切り処理中にエラーが発生しました: %s", e)
             return False
 
 
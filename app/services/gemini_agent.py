@@ -0,0 +1,168 @@
+"""
+Geminiのネイティブfunction callingを使った軽量エージェント
+
+LangChainの`initialize_agent`を経由せず、`genai.GenerativeModel`に
+ツールを直接渡して呼び出すことで、プロンプトテンプレートの
+レンダリングやpydantic検証などの呼び出しごとのオーバーヘッドを
+省略する。
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import google.generativeai as genai
+
+# genai.configure()を済ませてからモデルを構築する
+import app.services.llm_config  # noqa: F401
+from app.services.calendar_tools import (
+    create_event_tool,
+    get_events_tool,
+    update_event_tool,
+    delete_event_tool,
+    search_events_by_title_tool,
+    get_current_datetime_tool,
+    parse_date_tool,
+    parse_dates_batch_tool,
+)
+
+MODEL_NAME = "gemini-2.5-flash-preview-04-17"
+
+# ツールの一覧と説明はスキーマとして構造的に登録されるため、
+# プロンプトに列挙し直さない（毎ターンの入力トークンを削減する）
+SYSTEM_PROMPT = """
+あなたはLINEユーザーのためのAIアシスタントです。ユーザーのカレンダー予定を管理します。
+登録されたツールを使用して、ユーザーの要求に応えてください。
+複数の日付表現を変換する場合は、1件ずつではなくparse_dates_batchを使用してください。
+ユーザーIDは必ず各ツールに渡してください。
+日本語で丁寧に対応してください。
+"""
+
+# LangChainの@toolラッパーから元のPython関数を取り出し、
+# Geminiにそのままツールとして渡す（スキーマは型注釈から自動生成される）
+_TOOL_FUNCTIONS = [
+    tool.func if getattr(tool, "func", None) else tool
+    for tool in (
+        create_event_tool,
+        get_events_tool,
+        update_event_tool,
+        delete_event_tool,
+        search_events_by_title_tool,
+        get_current_datetime_tool,
+        parse_date_tool,
+        parse_dates_batch_tool,
+    )
+]
+
+# モデルはプロセスごとに1回だけ構築する
+_model = genai.GenerativeModel(
+    MODEL_NAME,
+    tools=_TOOL_FUNCTIONS,
+    system_instruction=SYSTEM_PROMPT,
+)
+
+MAX_TOOL_TURNS = 3
+
+# ツール名から実体への対応表
+_TOOLS_BY_NAME = {func.__name__: func for func in _TOOL_FUNCTIONS}
+
+# 副作用のない参照系ツール（同一ターン内なら並列実行してよい）
+_READ_ONLY_TOOL_NAMES = frozenset(
+    {
+        "get_events_tool",
+        "search_events_by_title_tool",
+        "get_current_datetime_tool",
+        "parse_date_tool",
+        "parse_dates_batch_tool",
+    }
+)
+
+# 参照系ツールの並列実行用スレッドプール
+_tool_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="agent-tool")
+
+
+def _call_tool(function_call) -> Any:
+    """ツールを1つ実行する（失敗時はエラーメッセージを結果として返す）"""
+    func = _TOOLS_BY_NAME.get(function_call.name)
+    if func is None:
+        return f"不明なツールです: {function_call.name}"
+    try:
+        return func(**dict(function_call.args))
+    except Exception as e:
+        return f"ツールの実行中にエラーが発生しました: {e}"
+
+
+def _execute_tool_calls(function_calls) -> list:
+    """
+    1ターン分のツール呼び出しを実行し、FunctionResponseパーツ列を返す
+
+    参照系（カレンダー取得・検索・日付変換など）は互いに独立なので
+    並列に実行し、所要時間を最も遅い1件分に抑える。作成・更新・削除は
+    順序を保つ必要があるため呼び出し順に直列実行する。
+    """
+    results: Dict[int, Any] = {}
+    read_only = [(i, fc) for i, fc in enumerate(function_calls) if fc.name in _READ_ONLY_TOOL_NAMES]
+    mutating = [(i, fc) for i, fc in enumerate(function_calls) if fc.name not in _READ_ONLY_TOOL_NAMES]
+
+    if len(read_only) > 1:
+        futures = {_tool_pool.submit(_call_tool, fc): i for i, fc in read_only}
+        for future, i in futures.items():
+            results[i] = future.result()
+    else:
+        for i, fc in read_only:
+            results[i] = _call_tool(fc)
+
+    for i, fc in mutating:
+        results[i] = _call_tool(fc)
+
+    return [
+        genai.protos.Part(
+            function_response=genai.protos.FunctionResponse(
+                name=fc.name, response={"result": results[i]}
+            )
+        )
+        for i, fc in enumerate(function_calls)
+    ]
+
+
+def run_agent(user_id: str, user_message: str, history: Optional[List[Dict]] = None) -> str:
+    """
+    ユーザーメッセージに対してツール呼び出しを含むエージェント処理を実行する
+
+    Args:
+        user_id: ユーザーID
+        user_message: ユーザーからのメッセージ
+        history: 過去の会話履歴（genai形式: {"role": ..., "parts": [...]}のリスト）
+
+    Returns:
+        AIからの応答テキスト
+    """
+    # ユーザーIDは毎ターンのメッセージに埋め込まず、履歴先頭の固定
+    # プリアンブルとして渡す。これによりプロンプトの先頭部分がターン間で
+    # バイト単位で安定し、プロバイダ側のプロンプトキャッシュが効きやすくなる。
+    preamble = [
+        {"role": "user", "parts": [f"ユーザーID: {user_id}"]},
+        {"role": "model", "parts": ["承知しました。このユーザーIDを各ツールに渡します。"]},
+    ]
+
+    # function callingのループは自前で回す
+    # （SDKの自動実行はツールを1つずつ直列に呼ぶため、参照系の
+    #   並列実行ができない）
+    chat = _model.start_chat(history=preamble + (history or []))
+    response = chat.send_message(user_message)
+
+    for _ in range(MAX_TOOL_TURNS):
+        function_calls = [part.function_call for part in response.parts if part.function_call]
+        if not function_calls:
+            break
+        response = chat.send_message(_execute_tool_calls(function_calls))
+
+    if any(part.function_call for part in response.parts):
+        # ツール呼び出しが上限ターン数で収束しなかった
+        return "申し訳ありません。処理が完了しませんでした。もう一度お試しください。"
+    return response.text
+
+
+async def arun_agent(user_id: str, user_message: str, history: Optional[List[Dict]] = None) -> str:
+    """run_agentの非同期ラッパー（ブロッキング呼び出しをスレッドに逃がす）"""
+    return await asyncio.to_thread(run_agent, user_id, user_message, history)
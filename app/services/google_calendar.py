@@ -3,13 +3,42 @@ Googleカレンダーとの連携を管理するモジュール
 """
 
 import datetime
+import logging
+import threading
 from typing import Dict, List, Any, Optional
+from cachetools import TTLCache
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from google.auth.transport.requests import Request as GoogleRequest
 
-from app.services.database_factory import get_user_tokens, save_user_tokens
+from app.services.database_factory import get_user_tokens, save_user_tokens, user_has_tokens
+from app.services.token_cache import get_cached_credentials
+
+logger = logging.getLogger(__name__)
+
+# イベント一覧の短期キャッシュ（キー: (user_id, start_time, end_time)）
+# 1ターン中にエージェントが同じ期間を複数回照会してもAPI呼び出しは1回で済む。
+# TTLを30秒に抑えているため、他デバイスからの変更もすぐ反映される。
+_events_cache: TTLCache = TTLCache(maxsize=2048, ttl=30)
+# エージェントツールはスレッドプールから並列に呼ばれ、TTLCacheは
+# スレッドセーフではないため、_service_cacheと同様にロックで守る
+_events_cache_lock = threading.Lock()
+
+# サービスオブジェクトのキャッシュ（キー: (user_id, アクセストークン)）
+# build()は毎回discoveryドキュメントの解析とhttpクライアント構築を行うため、
+# トークンが変わらない限り同じResourceを使い回す。トークンがリフレッシュ
+# されるとキーが変わり、新しいサービスが構築される。
+# TTLはtoken_cache側の認証情報TTL（3300秒）に合わせる。
+_service_cache: TTLCache = TTLCache(maxsize=10_000, ttl=3300)
+_service_cache_lock = threading.Lock()
+
+
+def invalidate_events_cache(user_id: str) -> None:
+    """指定ユーザーのイベントキャッシュを破棄する（予定の作成・更新・削除後に呼ぶ）"""
+    with _events_cache_lock:
+        for key in [k for k in _events_cache.keys() if k[0] == user_id]:
+            _events_cache.pop(key, None)
 
 
 def check_user_auth_status(user_id: str) -> bool:
@@ -23,10 +52,10 @@ def check_user_auth_status(user_id: str) -> bool:
         認証済みの場合はTrue、それ以外はFalse
     """
     try:
-        tokens = get_user_tokens(user_id)
-        return bool(tokens)
+        # トークン本体は不要なので存在確認のみの軽量版を使う
+        return user_has_tokens(user_id)
     except Exception as e:
-        print(f"認証状態確認中にエラーが発生しました: {e}")
+        logger.error("認証状態確認中にエラーが発生しました: %s", e)
         return False
 
 
@@ -45,50 +74,36 @@ def get_google_calendar_service(user_id: str):
         HttpError: Google APIとの通信中にエラーが発生した場合
     """
     try:
-        print(f"Google Calendar サービス取得 - ユーザーID: {user_id}")
-        token_info = get_user_tokens(user_id)
-        if not token_info:
-            print(f"ユーザーID '{user_id}' の認証情報が見つかりません")
-            raise ValueError("ユーザーの認証情報が見つかりません")
+        logger.debug("Google Calendar サービス取得 - ユーザーID: %s", user_id)
 
-        print(f"トークン情報取得成功 - アクセストークン: {token_info.get('token')[:10]}...")
+        # キャッシュ経由で認証情報を取得（リフレッシュと保存はキャッシュ側で行う）
+        creds = get_cached_credentials(user_id)
+        if not creds:
+            logger.warning("ユーザーID '%s' の認証情報が見つかりません", user_id)
+            raise ValueError("ユーザーの認証情報が見つかりません")
 
-        # 認証情報の作成
-        creds = Credentials(
-            token=token_info.get("token"),
-            refresh_token=token_info.get("refresh_token"),
-            token_uri=token_info.get("token_uri"),
-            client_id=token_info.get("client_id"),
-            client_secret=token_info.get("client_secret"),
-            scopes=token_info.get("scopes"),
-        )
-
-        # トークンの有効期限が切れている場合は更新
-        if creds.expired and creds.refresh_token:
-            print("トークンの有効期限が切れています。更新を試みます...")
-            creds.refresh(GoogleRequest())
-
-            # 更新したトークン情報を保存
-            updated_token_info = {
-                "token": creds.token,
-                "refresh_token": creds.refresh_token,
-                "token_uri": creds.token_uri,
-                "client_id": creds.client_id,
-                "client_secret": creds.client_secret,
-                "scopes": creds.scopes,
-            }
-            save_user_tokens(user_id, updated_token_info)
-            print("トークン情報を更新しました")
+        # 同じトークンのうちは構築済みサービスを使い回す
+        cache_key = (user_id, creds.token)
+        with _service_cache_lock:
+            service = _service_cache.get(cache_key)
+        if service is not None:
+            return service
 
         # Google Calendar APIのサービスを構築
-        service = build("calendar", "v3", credentials=creds)
+        # static_discovery=Trueでネットワーク経由のdiscoveryドキュメント取得を避け、
+        # バンドル済み定義からクライアントを生成する
+        service = build(
+            "calendar", "v3", credentials=creds, cache_discovery=False, static_discovery=True
+        )
+        with _service_cache_lock:
+            _service_cache[cache_key] = service
         return service
 
     except HttpError as error:
-        print(f"Google API エラー: {error}")
+        logger.error("Google API エラー: %s", error)
         raise
     except Exception as e:
-        print(f"Error getting calendar service: {e}")
+        logger.error("Error getting calendar service: %s", e)
         raise ValueError(f"カレンダーサービスの取得中にエラーが発生しました: {e}")
 
 
@@ -133,19 +148,69 @@ def register_calendar_event(
 
         # イベントをカレンダーに挿入
         created_event = service.events().insert(calendarId="primary", body=event).execute()
-        print(f"イベントを作成しました: {created_event.get('htmlLink')}")
+        logger.debug("イベントを作成しました: %s", created_event.get("htmlLink"))
 
+        invalidate_events_cache(user_id)
         return created_event["id"]
 
     except HttpError as error:
-        print(f"Google API エラー: {error}")
+        logger.error("Google API エラー: %s", error)
         raise ValueError(f"イベント作成中にエラーが発生しました: {error}")
     except Exception as e:
-        print(f"イベント作成中に予期しないエラーが発生しました: {e}")
+        logger.error("イベント作成中に予期しないエラーが発生しました: %s", e)
         raise ValueError(f"イベント作成中にエラーが発生しました: {e}")
 
 
-def get_calendar_events(user_id: str, start_time: str, end_time: str) -> List[Dict[str, Any]]:
+def bulk_insert_events(user_id: str, events: List[Dict[str, Any]]) -> List[str]:
+    """
+    複数の予定をまとめてGoogleカレンダーに登録する
+
+    BatchHttpRequestで最大50件のinsertを1回のHTTP往復に多重化する
+    （グループ日程をメンバー分登録する場合など、1件ずつの往復を避ける）。
+
+    Args:
+        user_id: ユーザーID
+        events: Calendar APIのイベントリソース（summary, start, endなど）のリスト
+
+    Returns:
+        作成されたイベントIDのリスト（失敗したものは含まれない）
+
+    Raises:
+        ValueError: 認証情報が見つからない場合
+    """
+    try:
+        service = get_google_calendar_service(user_id)
+
+        created_ids: List[str] = []
+
+        def _collect(request_id, response, exception):
+            if exception is not None:
+                logger.error("一括登録中にエラーが発生しました: %s", exception)
+            else:
+                created_ids.append(response["id"])
+
+        # APIの上限に合わせて50件ずつコミットする
+        for start in range(0, len(events), 50):
+            batch = service.new_batch_http_request(callback=_collect)
+            for event in events[start:start + 50]:
+                batch.add(service.events().insert(calendarId="primary", body=event))
+            batch.execute()
+
+        logger.debug("%d件のイベントを一括作成しました", len(created_ids))
+        invalidate_events_cache(user_id)
+        return created_ids
+
+    except HttpError as error:
+        logger.error("Google API エラー: %s", error)
+        raise ValueError(f"イベント一括作成中にエラーが発生しました: {error}")
+    except Exception as e:
+        logger.error("イベント一括作成中に予期しないエラーが発生しました: %s", e)
+        raise ValueError(f"イベント一括作成中にエラーが発生しました: {e}")
+
+
+def get_calendar_events(
+    user_id: str, start_time: str, end_time: str, query: Optional[str] = None
+) -> List[Dict[str, Any]]:
     """
     指定期間のカレンダー予定を取得する
 
@@ -153,6 +218,7 @@ def get_calendar_events(user_id: str, start_time: str, end_time: str) -> List[Di
         user_id: ユーザーID
         start_time: 取得開始時間（ISO 8601形式）
         end_time: 取得終了時間（ISO 8601形式）
+        query: フリーテキスト検索キーワード（指定時はサーバー側で絞り込む）
 
     Returns:
         イベントのリスト
@@ -162,31 +228,40 @@ def get_calendar_events(user_id: str, start_time: str, end_time: str) -> List[Di
         HttpError: Google APIとの通信中にエラーが発生した場合
     """
     try:
+        cache_key = (user_id, start_time, end_time, query)
+        with _events_cache_lock:
+            cached = _events_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
         service = get_google_calendar_service(user_id)
 
         # イベントの取得
-        events_result = (
-            service.events()
-            .list(
-                calendarId="primary",
-                timeMin=start_time,
-                timeMax=end_time,
-                singleEvents=True,
-                orderBy="startTime",
-            )
-            .execute()
+        # qパラメータを渡すとAPI側で絞り込まれるため、
+        # 全件を転送してPython側でフィルタリングする必要がない
+        list_kwargs = dict(
+            calendarId="primary",
+            timeMin=start_time,
+            timeMax=end_time,
+            singleEvents=True,
+            orderBy="startTime",
         )
+        if query:
+            list_kwargs["q"] = query
+        events_result = service.events().list(**list_kwargs).execute()
 
         events = events_result.get("items", [])
-        print(f"{len(events)}件のイベントを取得しました")
+        logger.debug("%d件のイベントを取得しました", len(events))
 
+        with _events_cache_lock:
+            _events_cache[cache_key] = events
         return events
 
     except HttpError as error:
-        print(f"Google API エラー: {error}")
+        logger.error("Google API エラー: %s", error)
         return []
     except Exception as e:
-        print(f"イベント取得中にエラーが発生しました: {e}")
+        logger.error("イベント取得中にエラーが発生しました: %s", e)
         return []
 
 
@@ -209,7 +284,9 @@ def find_event_by_query(service, event_query: Dict[str, Any]) -> Optional[Dict[s
 
         # タイトルで検索する場合
         if "summary" in event_query:
-            # 今日から1ヶ月間のイベントを取得
+            # 今日から1ヶ月間をqパラメータでAPI側に絞り込ませる
+            # （全イベントを転送してPython側で照合しない）
+            # fieldsで必要なフィールドのみ転送する
             now = datetime.datetime.utcnow()
             time_min = now.isoformat() + "Z"
             one_month_later = (now + datetime.timedelta(days=30)).isoformat() + "Z"
@@ -220,26 +297,26 @@ def find_event_by_query(service, event_query: Dict[str, Any]) -> Optional[Dict[s
                     calendarId="primary",
                     timeMin=time_min,
                     timeMax=one_month_later,
+                    q=event_query["summary"],
                     singleEvents=True,
                     orderBy="startTime",
+                    maxResults=10,
+                    fields="items(id,summary,start,end,location,description)",
                 )
                 .execute()
             )
 
             events = events_result.get("items", [])
-
-            # タイトルが一致するイベントを検索
-            for event in events:
-                if event_query["summary"].lower() in event.get("summary", "").lower():
-                    return event
+            if events:
+                return events[0]
 
         return None
 
     except HttpError as error:
-        print(f"Google API エラー: {error}")
+        logger.error("Google API エラー: %s", error)
         return None
     except Exception as e:
-        print(f"イベント検索中にエラーが発生しました: {e}")
+        logger.error("イベント検索中にエラーが発生しました: %s", e)
         return None
 
 
@@ -261,42 +338,49 @@ def update_calendar_event(user_id: str, event_query: Dict[str, Any], updated_dat
     try:
         service = get_google_calendar_service(user_id)
 
-        # イベントを検索
-        event = find_event_by_query(service, event_query)
-        if not event:
-            raise ValueError("更新対象のイベントが見つかりません")
-
-        # 更新データの適用
+        # 更新対象のイベントIDを特定
+        # （IDが直接指定されている場合は事前取得せずそのまま使う）
+        if "id" in event_query:
+            event_id = event_query["id"]
+        else:
+            event = find_event_by_query(service, event_query)
+            if not event:
+                raise ValueError("更新対象のイベントが見つかりません")
+            event_id = event["id"]
+
+        # 変更のあったフィールドだけをpatchで送信する
+        # （updateと違い、イベント全体の取得・再送信が不要）
+        patch_body = {}
         if "title" in updated_data:
-            event["summary"] = updated_data["title"]
+            patch_body["summary"] = updated_data["title"]
         if "location" in updated_data:
-            event["location"] = updated_data["location"]
+            patch_body["location"] = updated_data["location"]
         if "description" in updated_data:
-            event["description"] = updated_data["description"]
+            patch_body["description"] = updated_data["description"]
         if "start_time" in updated_data:
-            event["start"] = {
+            patch_body["start"] = {
                 "dateTime": updated_data["start_time"],
                 "timeZone": "Asia/Tokyo",
             }
         if "end_time" in updated_data:
-            event["end"] = {
+            patch_body["end"] = {
                 "dateTime": updated_data["end_time"],
                 "timeZone": "Asia/Tokyo",
             }
 
-        # イベントの更新
         updated_event = (
-            service.events().update(calendarId="primary", eventId=event["id"], body=event).execute()
+            service.events().patch(calendarId="primary", eventId=event_id, body=patch_body).execute()
         )
 
-        print(f"イベントを更新しました: {updated_event.get('htmlLink')}")
+        logger.debug("イベントを更新しました: %s", updated_event.get("htmlLink"))
+        invalidate_events_cache(user_id)
         return True
 
     except HttpError as error:
-        print(f"Google API エラー: {error}")
+        logger.error("Google API エラー: %s", error)
         return False
     except Exception as e:
-        print(f"イベント更新中にエラーが発生しました: {e}")
+        logger.error("イベント更新中にエラーが発生しました: %s", e)
         return False
 
 
@@ -325,12 +409,13 @@ def delete_calendar_event(user_id: str, event_query: Dict[str, Any]) -> bool:
         # イベントの削除
         service.events().delete(calendarId="primary", eventId=event["id"]).execute()
 
-        print(f"イベントを削除しました: {event.get('summary')}")
+        logger.debug("イベントを削除しました: %s", event.get("summary"))
+        invalidate_events_cache(user_id)
         return True
 
     except HttpError as error:
-        print(f"Google API エラー: {error}")
+        logger.error("Google API エラー: %s", error)
         return False
     except Exception as e:
-        print(f"イベント削除中にエラーが発生しました: {e}")
+        logger.error("イベント削除中にエラーが発生しました: %s", e)
         return False
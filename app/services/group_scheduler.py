@@ -1,12 +1,23 @@
 import os
 import json
+import logging
+import threading
 import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
 from typing import Dict, List, Any, Optional
 from datetime import datetime, timedelta
 
 from app.services.database_factory import save_group_schedule, get_group_schedules, update_vote, close_vote
-from linebot.v3.messaging import FlexMessage, FlexContainer, FlexBubble, FlexBox, FlexButton, FlexText
-from linebot.v3.messaging import MessagingApi, ApiClient, Configuration, PushMessageRequest
+from linebot.v3.messaging import (
+    FlexMessage,
+    FlexBubble,
+    FlexBox,
+    FlexButton,
+    FlexText,
+    PostbackAction,
+)
 
 from app.services.google_calendar import (
     get_google_calendar_service,
@@ -14,71 +25,111 @@ from app.services.google_calendar import (
     register_calendar_event,
 )
 
+logger = logging.getLogger(__name__)
+
+# 進行中の投票状態（プロセス内）
+# 複数ワーカーのWebhookハンドラから同時にアクセスされるためロックで保護する
+_votes: Dict[str, Dict[str, Any]] = {}
+_votes_lock = threading.Lock()
+
+
+@lru_cache(maxsize=64)
+def _slot_template(start_date: str, end_date: str) -> tuple:
+    """
+    平日9-18時の30分刻み候補スロット開始時刻（エポック秒）の列を生成する
+
+    期間の形だけで決まる純粋関数なのでメモ化する。同じ期間で繰り返し
+    照会されるケース（同一グループでの再検索など）では構築が1回で済む。
+    """
+    start_dt = datetime.fromisoformat(start_date.replace("Z", "+00:00"))
+    end_dt = datetime.fromisoformat(end_date.replace("Z", "+00:00"))
+
+    slot_starts = []
+    current_dt = start_dt
+    while current_dt < end_dt:
+        if current_dt.weekday() < 5:
+            day_start_ts = int(
+                current_dt.replace(hour=9, minute=0, second=0, microsecond=0).timestamp()
+            )
+            slot_starts.extend(range(day_start_ts, day_start_ts + 9 * 3600, 1800))
+        current_dt = current_dt + timedelta(days=1)
+    return tuple(slot_starts)
+
 
 def find_available_times(
     organizer_id: str, participant_ids: List[str], start_date: str, end_date: str, duration_minutes: int = 60
 ) -> List[Dict[str, Any]]:
     """グループメンバーの空き時間を検索する"""
     try:
+        # メンバーごとのカレンダー取得は独立したネットワークI/Oなので並列に行う
+        # （所要時間が人数分の合計ではなく最も遅い1人分になる。
+        #   同一期間の再取得はgoogle_calendar側の短期キャッシュが吸収する）
+        user_ids = [organizer_id] + participant_ids
         all_events = []
-        for user_id in [organizer_id] + participant_ids:
-            events = get_calendar_events(user_id, start_date, end_date)
-            all_events.extend([(event, user_id) for event in events])
-
-        slots = []
-        start_dt = datetime.fromisoformat(start_date.replace("Z", "+00:00"))
-        end_dt = datetime.fromisoformat(end_date.replace("Z", "+00:00"))
-
-        current_dt = start_dt
-        while current_dt < end_dt:
-            if current_dt.weekday() < 5:
-                day_start = current_dt.replace(hour=9, minute=0, second=0, microsecond=0)
-                day_end = current_dt.replace(hour=18, minute=0, second=0, microsecond=0)
-
-                slot_start = day_start
-                while slot_start < day_end:
-                    slot_end = slot_start + timedelta(minutes=30)
-                    slots.append(
-                        {"start": slot_start.isoformat(), "end": slot_end.isoformat(), "available": True}
-                    )
-                    slot_start = slot_end
-
-            current_dt = current_dt + timedelta(days=1)
-
-        for event, user_id in all_events:
-            event_start = datetime.fromisoformat(event["start"]["dateTime"].replace("Z", "+00:00"))
-            event_end = datetime.fromisoformat(event["end"]["dateTime"].replace("Z", "+00:00"))
-
-            for slot in slots:
-                slot_start = datetime.fromisoformat(slot["start"])
-                slot_end = datetime.fromisoformat(slot["end"])
-
-                if slot_start < event_end and slot_end > event_start:
-                    slot["available"] = False
+        with ThreadPoolExecutor(max_workers=min(8, len(user_ids))) as executor:
+            futures = {
+                executor.submit(get_calendar_events, user_id, start_date, end_date): user_id
+                for user_id in user_ids
+            }
+            for future in as_completed(futures):
+                user_id = futures[future]
+                all_events.extend((event, user_id) for event in future.result())
+
+        # 区間計算はすべてエポック秒のint演算で行い、datetimeオブジェクトの
+        # 生成は入力のパースと結果の出力時だけに抑える
+        event_intervals = [
+            (
+                int(datetime.fromisoformat(event["start"]["dateTime"].replace("Z", "+00:00")).timestamp()),
+                int(datetime.fromisoformat(event["end"]["dateTime"].replace("Z", "+00:00")).timestamp()),
+            )
+            for event, user_id in all_events
+        ]
+
+        tz = datetime.fromisoformat(start_date.replace("Z", "+00:00")).tzinfo
+        slot_starts = _slot_template(start_date, end_date)
+        available = [True] * len(slot_starts)
+
+        # 全イベントを開始時刻順に整列し、重なり合う区間をマージして
+        # 互いに素な「busy」区間列を作る（イベント数Eに対しO(E log E)）
+        busy = []
+        for interval_start, interval_end in sorted(event_intervals):
+            if busy and interval_start <= busy[-1][1]:
+                if interval_end > busy[-1][1]:
+                    busy[-1][1] = interval_end
+            else:
+                busy.append([interval_start, interval_end])
+
+        # スロット列とbusy区間列はどちらも昇順なので、2ポインタで1パス走査できる
+        # （従来のスロット×イベントの全組み合わせ比較 O(E*S) を O(E+S) に）
+        busy_idx = 0
+        for i, slot_start_ts in enumerate(slot_starts):
+            while busy_idx < len(busy) and busy[busy_idx][1] <= slot_start_ts:
+                busy_idx += 1
+            if busy_idx < len(busy) and busy[busy_idx][0] < slot_start_ts + 1800:
+                available[i] = False
 
         required_consecutive_slots = duration_minutes // 30
+        duration = timedelta(minutes=duration_minutes)
         available_times = []
 
-        i = 0
-        while i <= len(slots) - required_consecutive_slots:
-            consecutive_available = True
-            for j in range(required_consecutive_slots):
-                if i + j >= len(slots) or not slots[i + j]["available"]:
-                    consecutive_available = False
-                    break
-
-            if consecutive_available:
-                start_time = datetime.fromisoformat(slots[i]["start"])
-                end_time = start_time + timedelta(minutes=duration_minutes)
-
-                available_times.append({"start": start_time.isoformat(), "end": end_time.isoformat()})
-
-            i += 1
+        # 空きスロットの連続ラン [run_start, i) を検出し、
+        # 必要な連続数を満たす各開始位置から候補窓を切り出す
+        # （datetimeの構築は出力する候補窓1つにつき1回だけ）
+        run_start = 0
+        for i in range(len(slot_starts) + 1):
+            if i < len(slot_starts) and available[i]:
+                continue
+            for k in range(run_start, i - required_consecutive_slots + 1):
+                start_time = datetime.fromtimestamp(slot_starts[k], tz)
+                available_times.append(
+                    {"start": start_time.isoformat(), "end": (start_time + duration).isoformat()}
+                )
+            run_start = i + 1
 
         return available_times
 
     except Exception as e:
-        print(f"Error finding available times: {e}")
+        logger.error("空き時間の検索中にエラーが発生しました: %s", e)
         return []
 
 
@@ -89,107 +140,102 @@ def create_voting_message(
     try:
         options = available_times[:max_options]
 
-        bubble = {
-            "type": "bubble",
-            "header": {
-                "type": "box",
-                "layout": "vertical",
-                "contents": [
-                    {"type": "text", "text": f"{event_title} - 日程投票", "weight": "bold", "size": "lg"}
-                ],
-            },
-            "body": {"type": "box", "layout": "vertical", "contents": []},
-            "footer": {
-                "type": "box",
-                "layout": "vertical",
-                "contents": [
-                    {
-                        "type": "button",
-                        "action": {
-                            "type": "postback",
-                            "label": "投票を締め切る",
-                            "data": f"close_vote_{group_id}_{event_title}",
-                        },
-                        "style": "primary",
-                    }
-                ],
-            },
-        }
-
-        for i, option in enumerate(options):
-            start_dt = datetime.fromisoformat(option["start"])
-            formatted_date = start_dt.strftime("%m/%d(%a) %H:%M")
-
-            bubble["body"]["contents"].append(
-                {
-                    "type": "button",
-                    "action": {
-                        "type": "postback",
-                        "label": formatted_date,
-                        "data": f"vote_{group_id}_{event_title}_{i}_{option['start']}_{option['end']}",
-                    },
-                    "style": "secondary",
-                    "margin": "sm",
-                }
+        # 選択肢の日時やタイトルはサーバー側の投票状態に保持し、
+        # ポストバックには短い不透明トークンだけを載せる
+        # （LINEのdata上限300バイトに収まり、タイトルに任意の文字を使える）
+        vote_id = uuid.uuid4().hex[:12]
+        with _votes_lock:
+            _votes[vote_id] = {
+                "group_id": group_id,
+                "title": event_title,
+                "options": options,
+                "votes": {},
+            }
+
+        # SDKオブジェクトを直接構築する
+        # （dictを組み立ててFlexContainer.from_dictで再検証するJSON往復を省く）
+        option_buttons = [
+            FlexButton(
+                action=PostbackAction(
+                    label=datetime.fromisoformat(option["start"]).strftime("%m/%d(%a) %H:%M"),
+                    data=f"v:{vote_id}:{i}",
+                ),
+                style="secondary",
+                margin="sm",
             )
-
-        flex_message = FlexMessage(
-            alt_text=f"{event_title}の日程投票", contents=FlexContainer.from_dict(bubble)
+            for i, option in enumerate(options)
+        ]
+
+        bubble = FlexBubble(
+            header=FlexBox(
+                layout="vertical",
+                contents=[FlexText(text=f"{event_title} - 日程投票", weight="bold", size="lg")],
+            ),
+            body=FlexBox(layout="vertical", contents=option_buttons),
+            footer=FlexBox(
+                layout="vertical",
+                contents=[
+                    FlexButton(
+                        action=PostbackAction(
+                            label="投票を締め切る",
+                            data=f"c:{vote_id}",
+                        ),
+                        style="primary",
+                    )
+                ],
+            ),
         )
 
-        return flex_message
+        return FlexMessage(alt_text=f"{event_title}の日程投票", contents=bubble)
 
     except Exception as e:
-        print(f"Error creating voting message: {e}")
+        logger.error("投票メッセージの作成中にエラーが発生しました: %s", e)
         return None
 
 
-def process_vote(
-    user_id: str, group_id: str, event_title: str, option_index: int, start_time: str, end_time: str
-) -> bool:
-    """投票を処理する"""
-    try:
-        global _votes
-        if "_votes" not in globals():
-            _votes = {}
-
-        vote_key = f"{group_id}_{event_title}"
-        if vote_key not in _votes:
-            _votes[vote_key] = {"title": event_title, "options": [], "votes": {}}
-
-        if len(_votes[vote_key]["options"]) <= option_index:
-            _votes[vote_key]["options"].append({"start": start_time, "end": end_time})
-
-        _votes[vote_key]["votes"][user_id] = option_index
-
-        return True
-
-    except Exception as e:
-        print(f"Error processing vote: {e}")
-        return False
+def process_vote(user_id: str, vote_id: str, option_index: int) -> Optional[str]:
+    """
+    投票を処理する
 
+    選択肢の日時はcreate_voting_messageが保存済みの投票状態から引くため、
+    ポストバックに含まれるのは投票IDと選択肢番号だけでよい。
 
-def close_voting(group_id: str, event_title: str, line_bot_api: MessagingApi) -> bool:
-    """投票を締め切り、最も多く投票された日時を選択する"""
+    Returns:
+        投票対象のイベントタイトル。投票が存在しない場合や失敗した場合はNone
+    """
     try:
-        global _votes
-        if "_votes" not in globals():
-            return False
-
-        vote_key = f"{group_id}_{event_title}"
-        if vote_key not in _votes:
-            return False
+        with _votes_lock:
+            vote_data = _votes.get(vote_id)
+            if vote_data is None or not (0 <= option_index < len(vote_data["options"])):
+                return None
+            vote_data["votes"][user_id] = option_index
+        return vote_data["title"]
 
-        vote_data = _votes[vote_key]
+    except Exception as e:
+        logger.error("投票の処理中にエラーが発生しました: %s", e)
+        return None
 
-        option_counts = [0] * len(vote_data["options"])
-        for user_id, option_index in vote_data["votes"].items():
-            option_counts[option_index] += 1
 
-        max_votes = max(option_counts)
-        winning_indices = [i for i, count in enumerate(option_counts) if count == max_votes]
+def close_voting(vote_id: str) -> Optional[tuple]:
+    """
+    投票を締め切り、最も多く投票された日時を選択する
 
-        winning_index = winning_indices[0]
+    Returns:
+        (イベントタイトル, グループへ送る結果通知メッセージ) のタプル。
+        投票が存在しない・票が無い・失敗した場合はNone
+        （送信は呼び出し側が返信にまとめて行い、往復を1回に抑える）
+    """
+    try:
+        with _votes_lock:
+            # 締め切り後の投票を受け付けないよう、ここで取り出して削除する
+            vote_data = _votes.pop(vote_id, None)
+        if vote_data is None or not vote_data["votes"]:
+            return None
+        event_title = vote_data["title"]
+
+        # 集計と最多得票の選出を1パスで行う
+        # （同数の場合は先に投票された選択肢が勝つ: Counterは挿入順で安定）
+        winning_index, _max_votes = Counter(vote_data["votes"].values()).most_common(1)[0]
         winning_option = vote_data["options"][winning_index]
 
         for user_id in vote_data["votes"].keys():
@@ -205,14 +251,8 @@ def close_voting(group_id: str, event_title: str, line_bot_api: MessagingApi) ->
 
         message = f"{event_title}の日程が決定しました：{formatted_date}\n参加者全員のGoogleカレンダーに登録しました。"
 
-        line_bot_api.push_message(
-            PushMessageRequest(to=group_id, messages=[{"type": "text", "text": message}])
-        )
-
-        del _votes[vote_key]
-
-        return True
+        return event_title, message
 
     except Exception as e:
-        print(f"Error closing voting: {e}")
-        return False
+        logger.error("投票の締め切り処理中にエラーが発生しました: %s", e)
+        return None
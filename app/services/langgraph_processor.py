@@ -3,13 +3,20 @@ LangGraphを使用したAIプロセッサ
 会話履歴を管理し、ユーザーのメッセージを処理するためのモジュール
 """
 
+import asyncio
+import datetime
+import itertools
+import logging
+import operator
 import os
+import re
 import warnings
-from typing import List, TypedDict, Literal, Dict, Any, Optional, Tuple
+import weakref
+from collections import OrderedDict, deque
+from functools import lru_cache
+from typing import Annotated, Deque, List, TypedDict, Literal, Dict, Any, Optional, Tuple
 
-# 外部ライブラリのインポート
-from dotenv import load_dotenv
-import google.generativeai as genai
+from cachetools import TTLCache
 
 # LangGraph関連のインポート
 from langgraph.graph import StateGraph, END
@@ -17,110 +24,246 @@ from langgraph.graph import StateGraph, END
 # LangChain関連のインポート
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage, BaseMessage
 from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain.agents import AgentType, initialize_agent
 
 # アプリケーション内のインポート
-from app.services.calendar_tools import (
-    create_event_tool,
-    get_events_tool,
-    update_event_tool,
-    delete_event_tool,
-    search_events_by_title_tool,
-    get_current_datetime_tool,
-    parse_date_tool,
-)
+# （llm_configのインポートで.envの読み込みとgenai.configure()が1回だけ実行される）
+from app.services.llm_config import api_key
+from app.services.gemini_agent import arun_agent
+from app.services.calendar_tools import get_events_tool
+from app.services.database_factory import get_conversation, save_conversation_async
 
 # 非推奨の警告を抑制
 warnings.filterwarnings("ignore", category=UserWarning)
 
-# .env ファイルをロード
-dotenv_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), ".env")
-load_dotenv(dotenv_path=dotenv_path, verbose=True)
-
-# Gemini API設定: APIキーを使用して認証
-api_key = None
-if "GOOGLE_APPLICATION_CREDENTIALS" in os.environ:
-    # サービスアカウントキーを使用
-    print("サービスアカウントキーを使用して認証します...")
-    genai.configure(service_account_json=os.environ["GOOGLE_APPLICATION_CREDENTIALS"])
-elif "GEMINI_API_KEY" in os.environ:
-    # APIキーを使用
-    api_key = os.environ["GEMINI_API_KEY"]
-    print(f"取得したAPIキーの最初の5文字: {api_key[:5]}...")
-    genai.configure(api_key=api_key)
-else:
-    raise ValueError("GEMINI_API_KEY または GOOGLE_APPLICATION_CREDENTIALS が設定されていません")
-
-# LLMの設定
-llm = ChatGoogleGenerativeAI(
-    model="gemini-2.5-flash-preview-04-17",
-    temperature=0.7,
-    convert_system_message_to_human=True,
-    verbose=False,
-    google_api_key=api_key,  # APIキーを明示的に指定
-)
-
-# ユーザーごとのメモリを保持する辞書
-user_memories = {}
+logger = logging.getLogger(__name__)
 
 
-class AgentState(TypedDict):
+@lru_cache(maxsize=1)
+def get_llm() -> ChatGoogleGenerativeAI:
     """
-    エージェントの状態を表すクラス
+    通常応答用のLLMクライアントを取得する（初回利用時に構築）
 
-    Attributes:
-        messages: 現在の会話メッセージリスト
-        user_id: ユーザーID
-        chat_history: 過去の会話履歴
+    クライアントの構築はSDK初期化を伴うため、グラフ定義だけを使う
+    スクリプト（可視化やテスト）のimportが起動コストを払わないよう
+    遅延初期化にしている。
     """
+    return ChatGoogleGenerativeAI(
+        model="gemini-2.5-flash-preview-04-17",
+        temperature=0.7,
+        convert_system_message_to_human=True,
+        verbose=False,
+        google_api_key=api_key,  # APIキーを明示的に指定
+    )
 
-    messages: List[BaseMessage]
-    user_id: str
-    chat_history: List[BaseMessage]
+# ユーザーごとのメモリを保持するLRU辞書
+# （無制限に増え続けないよう、ユーザー数と1ユーザーあたりの履歴長を制限する）
+user_memories = OrderedDict()
 
+# 保持する最大ユーザー数（超過時は最も古いユーザーから破棄）
+MAX_MEMORY_USERS = 10_000
 
-# ツールの定義
-tools = [
-    create_event_tool,
-    get_events_tool,
-    update_event_tool,
-    delete_event_tool,
-    search_events_by_title_tool,
-    get_current_datetime_tool,
-    parse_date_tool,
-]
+# 1ユーザーあたり保持する最大メッセージ数
+# （プロンプトサイズがターン数に比例して増えるのを防ぐ）
+MAX_HISTORY_MESSAGES = 20
 
+# LLM呼び出しの同時実行数を制限するセマフォ
+# （遅いLLM呼び出しがスレッドプールを食い潰してWebhook受信を妨げないようにする）
+_LLM_SEM = asyncio.Semaphore(int(os.getenv("LLM_CONCURRENCY", "8")))
 
-def parse_user_input(state: AgentState) -> AgentState:
+class _LLMBatcher:
     """
-    ユーザー入力を解析し、ユーザーIDを抽出する
+    通常応答用LLM呼び出しのマイクロバッチ処理
 
-    Args:
-        state: 現在のエージェント状態
+    短い時間窓内に到着した複数ユーザーのプロンプトを1回のllm.abatchに
+    まとめ、リクエストごとのHTTP/TLSオーバーヘッドを償却する。
+    ツール使用ターンはバッチ対象外（generate_responseのみが使う）。
+    """
+
+    def __init__(self, max_batch: int = 8, window_ms: float = 20.0):
+        self._max_batch = max_batch
+        self._window = window_ms / 1000.0
+        # asyncio.Queueとタスクはイベントループに束縛されるため、ループごとに持つ。
+        # （同期ラッパーはasyncio.runで呼び出しごとに新しいループを作るので、
+        #   共有すると2回目以降のget()が別ループ束縛エラーでハングする。
+        #   閉じたループのエントリはWeakKeyDictionaryが自動的に回収する）
+        self._per_loop: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+    async def invoke(self, messages: List[BaseMessage]) -> BaseMessage:
+        """プロンプトをバッチに載せ、自分の応答だけを受け取る"""
+        loop = asyncio.get_running_loop()
+        # バッチループは実行中のループごとに遅延起動する
+        entry = self._per_loop.get(loop)
+        if entry is None or entry[1].done():
+            queue: asyncio.Queue = asyncio.Queue() if entry is None else entry[0]
+            entry = (queue, loop.create_task(self._batch_loop(queue)))
+            self._per_loop[loop] = entry
+        queue = entry[0]
+        future = loop.create_future()
+        queue.put_nowait((messages, future))
+        return await future
+
+    async def _batch_loop(self, queue: asyncio.Queue) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await queue.get()]
+            deadline = loop.time() + self._window
+            while len(batch) < self._max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            inputs = [messages for messages, _ in batch]
+            try:
+                llm = get_llm()
+                if len(inputs) == 1:
+                    results = [await llm.ainvoke(inputs[0])]
+                else:
+                    results = await llm.abatch(inputs)
+                for (_, future), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+
+_llm_batcher = _LLMBatcher()
+
+# 同一ユーザー×同一メッセージに対する応答の短期キャッシュ
+# （LINEの再送やダブルタップで同じテキストが連続して届いた場合に、
+#   グラフ実行とLLM往復を丸ごと省く。時間依存の応答が古くならないよう
+#   TTLは短めにしてある）
+_response_cache: TTLCache = TTLCache(maxsize=2_048, ttl=60)
+
+# 同一ユーザー×同一メッセージの「実行中」のグラフ呼び出しをまとめるマップ
+# （応答キャッシュは完了済みの重複しか防げない。並行して届いた重複は
+#   ここで1回の実行に相乗りさせ、二重課金とカレンダーへの二重書き込みを防ぐ）
+_inflight_messages: Dict[Tuple[str, str], asyncio.Future] = {}
+
+
+# ツール使用を示唆するキーワード群
+# 1語ずつの部分一致走査（キーワード数×テキスト長）を避けるため、
+# モジュールロード時に1本の正規表現へコンパイルして1回の走査で照合する
+_CALENDAR_KEYWORDS = (
+    "予定", "スケジュール", "カレンダー", "会議", "ミーティング", "イベント",
+    "作成", "登録", "追加", "設定", "入れて", "入力", "予約",
+    "確認", "チェック", "見せて", "教えて", "取得", "検索", "探して",
+    "変更", "更新", "修正", "編集", "削除", "キャンセル", "取り消し",
+    "何時", "何日", "いつ", "どこ", "場所",
+    "明日", "今日", "来週", "先週", "午前", "午後", "朝", "昼", "夕方", "夜",
+    "時間", "日程", "リマインド", "通知", "アラーム", "参加者", "招待", "出席者",
+)
+_CALENDAR_RE = re.compile("|".join(map(re.escape, _CALENDAR_KEYWORDS)))
+
+# 日付や時間の表現
+_TIME_PATTERN_RE = re.compile(
+    "|".join(map(re.escape, ("時", "分", "午前", "午後", "AM", "PM", "日", "月", "火", "水", "木", "金", "土")))
+)
+
+# 数字と組み合わさると時間・日付の可能性が高いコンテキスト
+_DIGIT_RE = re.compile(r"\d")
+_DIGIT_CONTEXT_RE = re.compile(
+    "|".join(map(re.escape, ("時", "分", "月", "日", "年", "時間", "日間", "週間")))
+)
+
+# 特定の質問パターン
+_QUESTION_RE = re.compile("|".join(map(re.escape, ("いつ", "どこで", "何時から", "何時まで", "どのくらい"))))
+
+# 「今日の予定を教えて」のような単純な参照リクエストのための
+# LLMを介さないファストパス（エージェント往復を丸ごと省略できる）
+_VIEW_FAST_PATH_RE = re.compile(r"^(今日|明日|明後日)の予定(?:を)?(?:教えて|見せて|確認)?(?:ください)?[。．!！]?$")
+_REL_DAYS = {"今日": 0, "明日": 1, "明後日": 2}
+_JST = datetime.timezone(datetime.timedelta(hours=9))
+
+# LangChainメッセージのtype属性からgenai履歴のroleへの対応表
+_GENAI_ROLES = {"human": "user", "ai": "model"}
+
+# 頻出の定型挨拶はLLMを介さず即答する
+# （Gemini往復が最大の遅延要因のため、これだけでp50が大きく下がる）
+_GREETING_RESPONSES = {
+    "こんにちは": "こんにちは！予定の確認や登録など、カレンダーのことなら何でもお手伝いします。",
+    "こんばんは": "こんばんは！予定の確認や登録など、お気軽にお申し付けください。",
+    "おはよう": "おはようございます！今日の予定の確認などお手伝いしましょうか？",
+    "おはようございます": "おはようございます！今日の予定の確認などお手伝いしましょうか？",
+    "はじめまして": "はじめまして！Googleカレンダーの予定を管理するアシスタントです。「明日の予定を教えて」のように話しかけてください。",
+    "ありがとう": "どういたしまして！他にもお手伝いできることがあれば教えてください。",
+    "ありがとうございます": "どういたしまして！他にもお手伝いできることがあれば教えてください。",
+}
+_GREETING_RE = re.compile(
+    r"^\s*(" + "|".join(map(re.escape, sorted(_GREETING_RESPONSES, key=len, reverse=True))) + r")\s*[。．.!！?？]*\s*$"
+)
+
+
+def _try_greeting(user_id: str, user_message: str) -> Optional[str]:
+    """
+    定型挨拶なら即座に定型応答を返し、会話履歴にも反映する
 
     Returns:
-        更新されたエージェント状態
+        定型応答テキスト。挨拶でない場合はNone
     """
-    print("ユーザー入力を解析中...")
-    # 既存の状態をコピー
-    new_state = state.copy()
-    print(f"ユーザーID: {new_state['user_id']}")
-    return new_state
+    m = _GREETING_RE.match(user_message)
+    if not m:
+        return None
+
+    reply = _GREETING_RESPONSES[m.group(1)]
+    history = get_or_create_memory(user_id)
+    history.extend((HumanMessage(content=user_message), AIMessage(content=reply)))
+    save_conversation_async(
+        user_id,
+        [{"role": msg.type, "content": msg.content} for msg in history if msg.type in _MESSAGE_TYPES],
+    )
+    return reply
 
 
-def retrieve_context(state: AgentState) -> AgentState:
+def _try_fast_path(user_id: str, user_message: str):
     """
-    会話履歴や関連情報を取得
-
-    Args:
-        state: 現在のエージェント状態
+    単純な予定参照メッセージをツール直接呼び出しで処理する
 
     Returns:
-        更新されたエージェント状態
+        応答テキスト。ファストパス対象外の場合はNone
+    """
+    m = _VIEW_FAST_PATH_RE.match(user_message.strip())
+    if not m:
+        return None
+
+    day_label = m.group(1)
+    day = datetime.datetime.now(_JST) + datetime.timedelta(days=_REL_DAYS[day_label])
+    start = day.replace(hour=0, minute=0, second=0, microsecond=0)
+    end = day.replace(hour=23, minute=59, second=59, microsecond=0)
+
+    events = get_events_tool.func(user_id, start.isoformat(), end.isoformat())
+    if not events:
+        return f"{day_label}の予定はありません。"
+
+    lines = [f"{day_label}の予定は{len(events)}件です。"]
+    for event in events:
+        start_str = event.get("start", "")
+        time_label = start_str[11:16] if len(start_str) > 10 else "終日"
+        lines.append(f"・{time_label} {event.get('summary', 'タイトルなし')}")
+    return "\n".join(lines)
+
+
+
+class AgentState(TypedDict):
+    """
+    エージェントの状態を表すクラス
+
+    Attributes:
+        messages: 現在の会話メッセージリスト
+            （operator.addリデューサ付き: 各ノードは追加分だけを返し、
+            結合はLangGraph側が行う）
+        user_id: ユーザーID
+        chat_history: 過去の会話履歴
     """
-    print("コンテキストを取得中...")
-    return state
+
+    messages: Annotated[List[BaseMessage], operator.add]
+    user_id: str
+    chat_history: Deque[BaseMessage]
 
 
 def should_use_tools(state: AgentState) -> Dict[str, Any]:
@@ -133,221 +276,107 @@ def should_use_tools(state: AgentState) -> Dict[str, Any]:
     Returns:
         次のステップを示す辞書: {"next": "use_tools"} または {"next": "generate_response"}
     """
+    logger.debug("ユーザーID: %s", state["user_id"])
+
     # 最新のユーザーメッセージを取得
     user_message = state["messages"][-1].content
 
     # 会話履歴から直近のメッセージを取得（文脈を理解するため）
     recent_context = ""
-    if state["chat_history"] and len(state["chat_history"]) > 0:
-        recent_messages = state["chat_history"][-3:]  # 直近3つのメッセージ
+    history = state["chat_history"]
+    if history:
+        # 直近3つのメッセージ（dequeはスライスできないためisliceで末尾を取る）
+        recent_messages = itertools.islice(history, max(0, len(history) - 3), len(history))
         recent_context = " ".join([msg.content for msg in recent_messages])
 
     # 検索対象のテキスト（現在のメッセージと直近の文脈）
     search_text = user_message + " " + recent_context
 
-    # ツールを使用する可能性が高いキーワードのリスト
-    calendar_keywords = [
-        "予定",
-        "スケジュール",
-        "カレンダー",
-        "会議",
-        "ミーティング",
-        "イベント",
-        "作成",
-        "登録",
-        "追加",
-        "設定",
-        "入れて",
-        "入力",
-        "予約",
-        "確認",
-        "チェック",
-        "見せて",
-        "教えて",
-        "取得",
-        "検索",
-        "探して",
-        "変更",
-        "更新",
-        "修正",
-        "編集",
-        "削除",
-        "キャンセル",
-        "取り消し",
-        "何時",
-        "何日",
-        "いつ",
-        "どこ",
-        "場所",
-        "明日",
-        "今日",
-        "来週",
-        "先週",
-        "午前",
-        "午後",
-        "朝",
-        "昼",
-        "夕方",
-        "夜",
-        "時間",
-        "日程",
-        "リマインド",
-        "通知",
-        "アラーム",
-        "参加者",
-        "招待",
-        "出席者",
-    ]
-
     # メッセージ内にカレンダー関連のキーワードが含まれているかチェック
-    for keyword in calendar_keywords:
-        if keyword in search_text:
-            print(f"キーワード '{keyword}' が見つかりました。ツールを使用します。")
-            return {"next": "use_tools"}
+    m = _CALENDAR_RE.search(search_text)
+    if m:
+        logger.debug("キーワード '%s' が見つかりました。ツールを使用します。", m.group())
+        return {"next": "use_tools"}
 
     # 日付や時間の表現が含まれているかチェック
-    time_patterns = ["時", "分", "午前", "午後", "AM", "PM", "日", "月", "火", "水", "木", "金", "土"]
-    for pattern in time_patterns:
-        if pattern in search_text:
-            print(f"時間パターン '{pattern}' が見つかりました。ツールを使用します。")
-            return {"next": "use_tools"}
+    m = _TIME_PATTERN_RE.search(search_text)
+    if m:
+        logger.debug("時間パターン '%s' が見つかりました。ツールを使用します。", m.group())
+        return {"next": "use_tools"}
 
     # 数字が含まれているかチェック（時間や日付の可能性）
-    if any(char.isdigit() for char in search_text):
-        # 数字の前後のコンテキストを確認
+    if _DIGIT_RE.search(search_text):
         # 単なる数字の言及なのか、時間や日付の指定なのかを判断
-        digit_contexts = ["時", "分", "月", "日", "年", "時間", "日間", "週間"]
-        for context in digit_contexts:
-            if context in search_text:
-                print(f"数字と時間コンテキスト '{context}' が見つかりました。ツールを使用します。")
-                return {"next": "use_tools"}
+        m = _DIGIT_CONTEXT_RE.search(search_text)
+        if m:
+            logger.debug("数字と時間コンテキスト '%s' が見つかりました。ツールを使用します。", m.group())
+            return {"next": "use_tools"}
 
     # 特定の質問パターンをチェック
-    question_patterns = ["いつ", "どこで", "何時から", "何時まで", "どのくらい"]
-    for pattern in question_patterns:
-        if pattern in search_text:
-            print(f"質問パターン '{pattern}' が見つかりました。ツールを使用します。")
-            return {"next": "use_tools"}
+    m = _QUESTION_RE.search(search_text)
+    if m:
+        logger.debug("質問パターン '%s' が見つかりました。ツールを使用します。", m.group())
+        return {"next": "use_tools"}
 
     # 以上のパターンに一致しない場合は、通常の応答を生成
-    print("ツールを使用する必要はありません。通常の応答を生成します。")
+    logger.debug("ツールを使用する必要はありません。通常の応答を生成します。")
     return {"next": "generate_response"}
 
 
-def use_tools(state: AgentState) -> AgentState:
+async def use_tools(state: AgentState) -> Dict[str, Any]:
     """
     必要に応じてツールを呼び出す
 
+    非同期ノードとして実行され、ツールやLLMへのI/O待ちの間は
+    イベントループが他のリクエストを処理できる。
+
     Args:
         state: 現在のエージェント状態
 
     Returns:
-        更新されたエージェント状態（ツール実行結果を含む）
+        状態の更新差分（ツール実行結果のAI応答を含む）
     """
-    print("ツールを使用中...")
-
-    # システムプロンプトの定義
-    system_prompt = """
-あなたはLINEユーザーのためのAIアシスタントです。ユーザーのカレンダー予定を管理します。
-以下のツールを使用して、ユーザーの要求に応えてください：
-
-1. create_event - 新しい予定をGoogleカレンダーに作成します
-2. get_events - 指定された期間の予定を取得します
-3. update_event - 既存の予定を更新します
-4. delete_event - 予定を削除します
-5. search_events_by_title - タイトルで予定を検索します
-6. get_current_datetime - 現在の日時を取得します
-7. parse_date - 自然言語の日付表現をISO形式に変換します
-
-ユーザーIDは必ず各ツールに渡してください。
-ユーザーの要求を理解し、適切なツールを選択して実行してください。
-日本語で丁寧に対応してください。
-常に丁寧に対応してください。
-"""
-
-    # プロンプトテンプレートの作成
-    prompt = ChatPromptTemplate.from_messages(
-        [
-            ("system", system_prompt),
-            MessagesPlaceholder(variable_name="chat_history"),
-            ("human", "{input}"),
-            MessagesPlaceholder(variable_name="agent_scratchpad"),
-        ]
-    )
-
-    # エージェントを作成
-    agent_executor = initialize_agent(
-        tools,
-        llm,
-        agent=AgentType.STRUCTURED_CHAT_ZERO_SHOT_REACT_DESCRIPTION,
-        verbose=False,
-        handle_parsing_errors=True,
-        prompt=prompt,
-        max_iterations=10,
-        early_stopping_method="force",
-        return_intermediate_steps=True,
-    )
+    logger.debug("ツールを使用中...")
 
     try:
         # ユーザーIDをより明示的に指定
         user_id_str = state["user_id"]
-        print(f"ツール呼び出し時のユーザーID: {user_id_str}")
-
-        # 会話履歴をフォーマット
-        formatted_chat_history = []
-        for msg in state["chat_history"]:
-            if isinstance(msg, HumanMessage):
-                formatted_chat_history.append({"role": "human", "content": msg.content})
-            elif isinstance(msg, AIMessage):
-                formatted_chat_history.append({"role": "ai", "content": msg.content})
-
-        # ツール呼び出し時にユーザーIDを明示的に含める
-        result = agent_executor.invoke(
-            {
-                "input": f"ユーザーID: {user_id_str}\n{state['messages'][-1].content}",
-                "chat_history": formatted_chat_history,
-                "user_id": user_id_str,
-            }
-        )
-
-        # ツール呼び出しの結果を取得
-        tool_result = result["output"]
-
-        # 中間ステップ（ツールの実行ステップ）を取得
-        if "intermediate_steps" in result and result["intermediate_steps"]:
-            # ツールの実行ステップを出力
-            print("ツール実行ステップ:")
-            for i, (action, action_output) in enumerate(result["intermediate_steps"]):
-                print(f"ステップ {i+1}:")
-                print(f"  ツール: {action.tool}")
-                print(f"  入力: {action.tool_input}")
-                print(f"  出力: {action_output}")
-
-            # 最後のツール実行結果を使用
-            if result["intermediate_steps"]:
-                last_step = result["intermediate_steps"][-1]
-                last_action, last_output = last_step
-                print(f"最後のツール実行: {last_action.tool}")
-                print(f"最後のツール出力: {last_output}")
-
-        # 新しい状態を作成
-        new_state = state.copy()
+        logger.debug("ツール呼び出し時のユーザーID: %s", user_id_str)
+
+        # 単純な予定参照はLLMを介さず直接ツールを呼ぶ
+        # （カレンダーAPIへのブロッキング呼び出しはスレッドに逃がす）
+        fast_reply = await asyncio.to_thread(_try_fast_path, user_id_str, state["messages"][-1].content)
+        if fast_reply is not None:
+            logger.debug("ファストパスで応答しました")
+            return {"messages": [AIMessage(content=fast_reply)]}
+
+        # 会話履歴をgenai形式に変換する
+        # （genai SDKはdict形式の履歴しか受け付けないため変換自体は省けないが、
+        #   isinstance判定の連鎖をmsg.typeのテーブル参照1回に置き換える）
+        formatted_chat_history = [
+            {"role": _GENAI_ROLES[msg.type], "parts": [msg.content]}
+            for msg in state["chat_history"]
+            if msg.type in _GENAI_ROLES
+        ]
 
-        # AIの応答を追加
-        new_state["messages"] = state["messages"] + [AIMessage(content=tool_result)]
+        # Geminiのネイティブfunction callingでツールを実行
+        tool_result = await arun_agent(
+            user_id=user_id_str,
+            user_message=state["messages"][-1].content,
+            history=formatted_chat_history,
+        )
 
-        return new_state
+        # AIの応答を追加分として返す（結合はリデューサが行う）
+        return {"messages": [AIMessage(content=tool_result)]}
 
     except Exception as e:
-        print(f"ツール使用中にエラーが発生しました: {e}")
+        logger.exception("ツール使用中にエラーが発生しました: %s", e)
         # エラーが発生した場合は、エラーメッセージを応答として追加
-        error_message = f"申し訳ありません。処理中にエラーが発生しました。もう一度お試しください。"
-        new_state = state.copy()
-        new_state["messages"] = state["messages"] + [AIMessage(content=error_message)]
-        return new_state
+        error_message = "申し訳ありません。処理中にエラーが発生しました。もう一度お試しください。"
+        return {"messages": [AIMessage(content=error_message)]}
 
 
-def generate_response(state: AgentState) -> AgentState:
+async def generate_response(state: AgentState) -> Dict[str, Any]:
     """
     最終的な応答を生成
 
@@ -355,16 +384,14 @@ def generate_response(state: AgentState) -> AgentState:
         state: 現在のエージェント状態
 
     Returns:
-        更新されたエージェント状態（AI応答を含む）
+        状態の更新差分（AI応答を含む）
     """
-    print("応答を生成中...")
-    response = llm.invoke(state["messages"])
-    new_state = state.copy()
-    new_state["messages"] = state["messages"] + [response]
-    return new_state
+    logger.debug("応答を生成中...")
+    response = await _llm_batcher.invoke(state["messages"])
+    return {"messages": [response]}
 
 
-def update_chat_history(state: AgentState) -> AgentState:
+def update_chat_history(state: AgentState) -> Dict[str, Any]:
     """
     会話履歴を更新
 
@@ -372,13 +399,14 @@ def update_chat_history(state: AgentState) -> AgentState:
         state: 現在のエージェント状態
 
     Returns:
-        更新されたエージェント状態（更新された会話履歴を含む）
+        状態の更新差分（更新された会話履歴を含む）
     """
-    print("会話履歴を更新中...")
-    new_state = state.copy()
+    logger.debug("会話履歴を更新中...")
     # 現在のメッセージを履歴に追加
-    new_state["chat_history"] = state["chat_history"] + state["messages"]
-    return new_state
+    # （履歴はmaxlen付きdequeなので、追記はO(1)で上限超過分は自動的に落ちる）
+    history = state["chat_history"]
+    history.extend(state["messages"])
+    return {"chat_history": history}
 
 
 def build_graph() -> StateGraph:
@@ -392,19 +420,17 @@ def build_graph() -> StateGraph:
     workflow = StateGraph(AgentState)
 
     # ノードの追加
-    workflow.add_node("parse_user_input", parse_user_input)
-    workflow.add_node("retrieve_context", retrieve_context)
+    # （入力解析・コンテキスト取得はやることがなくなったため、
+    #   判定ノードに統合してグラフのホップ数を減らしている）
     workflow.add_node("should_use_tools", should_use_tools)
     workflow.add_node("use_tools", use_tools)
     workflow.add_node("generate_response", generate_response)
     workflow.add_node("update_chat_history", update_chat_history)
 
     # エントリーポイントを設定
-    workflow.set_entry_point("parse_user_input")
+    workflow.set_entry_point("should_use_tools")
 
     # エッジの追加
-    workflow.add_edge("parse_user_input", "retrieve_context")
-    workflow.add_edge("retrieve_context", "should_use_tools")
     workflow.add_conditional_edges(
         "should_use_tools",
         lambda x: x["next"],
@@ -425,10 +451,17 @@ def build_graph() -> StateGraph:
 agent_graph = build_graph()
 
 
+# 永続ストアの保存形式（role文字列）からメッセージクラスへの対応表
+_MESSAGE_TYPES = {"human": HumanMessage, "ai": AIMessage}
+
+
 def get_or_create_memory(user_id: str) -> List[BaseMessage]:
     """
     ユーザーIDに基づいてメモリを取得または作成
 
+    プロセス内に履歴が無い場合は永続ストアから復元するため、
+    ワーカーの再起動や複数プロセス構成でも会話が途切れない。
+
     Args:
         user_id: ユーザーID
 
@@ -436,13 +469,69 @@ def get_or_create_memory(user_id: str) -> List[BaseMessage]:
         ユーザーの会話履歴
     """
     if user_id not in user_memories:
-        user_memories[user_id] = []
+        history = deque(maxlen=MAX_HISTORY_MESSAGES)
+        for item in get_conversation(user_id):
+            message_cls = _MESSAGE_TYPES.get(item.get("role"))
+            if message_cls:
+                history.append(message_cls(content=item.get("content", "")))
+        user_memories[user_id] = history
+    else:
+        # 直近利用ユーザーとしてLRU順を更新
+        user_memories.move_to_end(user_id)
     return user_memories[user_id]
 
 
+def _build_inputs(user_id: str, user_message: str) -> AgentState:
+    """グラフ実行用の初期状態を構築する"""
+    return {
+        "messages": [HumanMessage(content=user_message)],
+        "user_id": user_id,
+        "chat_history": get_or_create_memory(user_id),
+    }
+
+
+def _extract_reply(result: AgentState, user_id: str) -> str:
+    """グラフの実行結果から最後のAI応答を取り出し、会話履歴を更新する"""
+    ai_message = None
+    for message in reversed(result["messages"]):
+        if isinstance(message, AIMessage):
+            ai_message = message
+            break
+
+    if not ai_message:
+        return "申し訳ありません。応答の生成中にエラーが発生しました。"
+
+    # 会話履歴を更新（dequeのmaxlenにより直近MAX_HISTORY_MESSAGES件のみ保持される）
+    user_memories[user_id] = result["chat_history"]
+    user_memories.move_to_end(user_id)
+
+    # ユーザー数の上限を超えたら最も古いユーザーから破棄
+    while len(user_memories) > MAX_MEMORY_USERS:
+        user_memories.popitem(last=False)
+
+    # 永続ストアへの保存はバックグラウンドに逃がす（応答は書き込みを待たない）
+    save_conversation_async(
+        user_id,
+        [
+            {"role": msg.type, "content": msg.content}
+            for msg in result["chat_history"]
+            if msg.type in _MESSAGE_TYPES
+        ],
+    )
+
+    return ai_message.content
+
+
+# グラフ実行時の設定
+_GRAPH_CONFIG = {"recursion_limit": 50}
+
+
 def process_user_message(user_id: str, user_message: str) -> str:
     """
-    ユーザーメッセージを処理
+    ユーザーメッセージを処理（同期版）
+
+    グラフのLLMノードは非同期のため、イベントループの外から使う
+    スクリプトやテスト向けに非同期版をasyncio.runでラップする。
 
     Args:
         user_id: ユーザーID
@@ -451,41 +540,61 @@ def process_user_message(user_id: str, user_message: str) -> str:
     Returns:
         AIからの応答
     """
-    print(f"ユーザーメッセージを処理中... ユーザーID: {user_id}")
-    print(f"メッセージ: {user_message}")
+    return asyncio.run(aprocess_user_message(user_id, user_message))
 
-    # ユーザーの会話履歴を取得
-    chat_history = get_or_create_memory(user_id)
 
-    # 初期状態の設定
-    config = {"recursion_limit": 50}
-    inputs = {
-        "messages": [HumanMessage(content=user_message)],
-        "user_id": user_id,
-        "chat_history": chat_history,
-    }
+async def aprocess_user_message(user_id: str, user_message: str) -> str:
+    """
+    ユーザーメッセージを非同期で処理する
 
-    try:
-        # グラフを実行
-        result = agent_graph.invoke(inputs, config=config)
+    グラフをainvokeで実行することで、LLMやカレンダーAPIへのI/O待ちの間に
+    他ユーザーのリクエストを処理できる。同時実行数はセマフォで制限する。
 
-        # 結果から最後のAIメッセージを取得
-        messages = result["messages"]
-        ai_message = None
-        for message in reversed(messages):
-            if isinstance(message, AIMessage):
-                ai_message = message
-                break
+    Args:
+        user_id: ユーザーID
+        user_message: ユーザーからのメッセージ
 
-        if not ai_message:
-            return "申し訳ありません。応答の生成中にエラーが発生しました。"
+    Returns:
+        AIからの応答
+    """
+    logger.info("ユーザーメッセージを処理中... ユーザーID: %s", user_id)
+    logger.debug("メッセージ: %s", user_message)
 
-        # 会話履歴を更新
-        user_memories[user_id] = result["chat_history"]
+    cache_key = (user_id, user_message)
+    cached = _response_cache.get(cache_key)
+    if cached is not None:
+        return cached
 
-        # AIの応答を返す
-        return ai_message.content
+    # 定型挨拶はグラフもLLMも通さず即答する
+    # （履歴の復元で永続ストアを読む可能性があるためスレッドに逃がす）
+    greeting = await asyncio.to_thread(_try_greeting, user_id, user_message)
+    if greeting is not None:
+        return greeting
 
-    except Exception as e:
-        print(f"メッセージ処理中にエラーが発生しました: {e}")
-        return f"申し訳ありません。エラーが発生しました: {str(e)}"
+    # 同じメッセージが実行中なら、その結果に相乗りする（singleflight）
+    existing = _inflight_messages.get(cache_key)
+    if existing is not None:
+        return await existing
+
+    future: asyncio.Future = asyncio.get_running_loop().create_future()
+    _inflight_messages[cache_key] = future
+
+    try:
+        async with _LLM_SEM:
+            try:
+                inputs = await asyncio.to_thread(_build_inputs, user_id, user_message)
+                result = await agent_graph.ainvoke(inputs, config=_GRAPH_CONFIG)
+                reply = _extract_reply(result, user_id)
+                _response_cache[cache_key] = reply
+
+            except Exception as e:
+                logger.exception("メッセージ処理中にエラーが発生しました: %s", e)
+                reply = f"申し訳ありません。エラーが発生しました: {str(e)}"
+
+        # 相乗りしている呼び出しにはエラー時も応答テキストをそのまま返す
+        future.set_result(reply)
+        return reply
+    finally:
+        _inflight_messages.pop(cache_key, None)
+        if not future.done():
+            future.cancel()
@@ -0,0 +1,33 @@
+"""
+LLM関連の共通設定モジュール
+
+.envの読み込みとgenai.configure()をプロセスごとに1回だけ行う。
+各サービスモジュールが個別に初期化を繰り返さないよう、
+Geminiを使うモジュールは本モジュールをインポートすること。
+"""
+
+import logging
+import os
+
+from dotenv import load_dotenv
+import google.generativeai as genai
+
+logger = logging.getLogger(__name__)
+
+# .env ファイルをロード（プロジェクトルート直下）
+dotenv_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), ".env")
+load_dotenv(dotenv_path=dotenv_path)
+
+# Gemini API設定: APIキーを使用して認証
+api_key = None
+if "GOOGLE_APPLICATION_CREDENTIALS" in os.environ:
+    # サービスアカウントキーを使用
+    logger.info("サービスアカウントキーを使用して認証します")
+    genai.configure(service_account_json=os.environ["GOOGLE_APPLICATION_CREDENTIALS"])
+elif "GEMINI_API_KEY" in os.environ:
+    # APIキーを使用
+    api_key = os.environ["GEMINI_API_KEY"]
+    logger.debug("GEMINI_API_KEYを使用して認証します")
+    genai.configure(api_key=api_key)
+else:
+    raise ValueError("GEMINI_API_KEY または GOOGLE_APPLICATION_CREDENTIALS が設定されていません")
@@ -0,0 +1,194 @@
+"""
+Googleアクセストークンのプロセス内キャッシュを管理するモジュール
+
+アクセストークンの有効期限は1時間のため、55分（安全マージン5分）の
+TTLでキャッシュし、同一ユーザーの連続したツール呼び出しで
+oauth2.googleapis.com/token への往復を省略する。
+"""
+
+import asyncio
+import datetime
+import hashlib
+import logging
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Optional
+
+from cachetools import TTLCache
+from google.oauth2.credentials import Credentials
+from google.auth.transport.requests import Request as GoogleRequest
+
+from app.services.database_factory import get_user_tokens, save_user_tokens_async
+
+# 55分 = 3300秒（Googleアクセストークンの1時間有効期限に5分のバッファ）
+_TOKEN_TTL_SECONDS = 3300
+
+_credentials_cache = TTLCache(maxsize=10_000, ttl=_TOKEN_TTL_SECONDS)
+# TTLCacheはスレッドセーフではない（get()でも内部のOrderedDictが動く）ため、
+# _credentials_cacheと_key_to_userへのアクセスはすべてこのロックで守る。
+# creds.refresh()などのネットワーク呼び出しはロックの外で行うこと。
+_credentials_cache_lock = threading.Lock()
+
+# ユーザーごとの再構築・リフレッシュ用ロック
+# （同一ユーザーの同時キャッシュミスで creds.refresh() が多重実行されると
+#   互いのトークンを無効化し合うため、1回にまとめる）
+_rebuild_locks: defaultdict = defaultdict(threading.Lock)
+_rebuild_locks_guard = threading.Lock()
+
+# キャッシュキーから元のuser_idへの逆引き（バックグラウンドリフレッシュ用）
+_key_to_user: Dict[str, str] = {}
+
+logger = logging.getLogger(__name__)
+
+
+def _cache_key(user_id: str) -> str:
+    """長いユーザーIDをハッシュ化してキャッシュキーにする"""
+    return hashlib.blake2s(user_id.encode()).hexdigest()
+
+
+def _remaining_ttl(creds: Credentials) -> int:
+    """認証情報の有効期限までの残り秒数（安全マージン込み）を返す"""
+    if creds.expiry is None:
+        return _TOKEN_TTL_SECONDS
+    remaining = (creds.expiry - datetime.datetime.utcnow()).total_seconds() - 300
+    return min(_TOKEN_TTL_SECONDS, max(0, int(remaining)))
+
+
+def get_cached_credentials(user_id: str) -> Optional[Credentials]:
+    """
+    ユーザーの認証情報をキャッシュ経由で取得する
+
+    キャッシュミス時はトークンストアから再構築し、有効期限が切れて
+    いればリフレッシュした上でキャッシュに格納する。
+
+    Args:
+        user_id: ユーザーID
+
+    Returns:
+        Credentialsオブジェクト、認証情報が見つからない場合はNone
+    """
+    key = _cache_key(user_id)
+    with _credentials_cache_lock:
+        creds = _credentials_cache.get(key)
+    if creds is not None and not creds.expired:
+        return creds
+
+    with _rebuild_locks_guard:
+        lock = _rebuild_locks[key]
+
+    with lock:
+        # ロック待ちの間に別スレッドが再構築済みならそれを使う
+        with _credentials_cache_lock:
+            creds = _credentials_cache.get(key)
+        if creds is not None and not creds.expired:
+            return creds
+        return _rebuild_credentials(user_id, key)
+
+
+def _rebuild_credentials(user_id: str, key: str) -> Optional[Credentials]:
+    """トークンストアからCredentialsを再構築し、必要ならリフレッシュする"""
+    token_info = get_user_tokens(user_id)
+    if not token_info:
+        return None
+
+    creds = Credentials(
+        token=token_info.get("token"),
+        refresh_token=token_info.get("refresh_token"),
+        token_uri=token_info.get("token_uri"),
+        client_id=token_info.get("client_id"),
+        client_secret=token_info.get("client_secret"),
+        scopes=token_info.get("scopes"),
+    )
+
+    if creds.expired and creds.refresh_token:
+        creds.refresh(GoogleRequest())
+        # 更新したトークン情報の保存はバックグラウンドに逃がす
+        # （以降のリクエストはキャッシュ済みCredentialsから読むため、
+        #   ユーザー応答は書き込み完了を待つ必要がない）
+        save_user_tokens_async(user_id, _to_token_info(creds))
+
+    # 有効期限が近い場合はTTLを短くする
+    ttl = _remaining_ttl(creds)
+    if ttl > 0:
+        with _credentials_cache_lock:
+            _credentials_cache[key] = creds
+            _key_to_user[key] = user_id
+    return creds
+
+
+def _to_token_info(creds: Credentials) -> dict:
+    """Credentialsをトークンストアの保存形式に変換する"""
+    return {
+        "token": creds.token,
+        "refresh_token": creds.refresh_token,
+        "token_uri": creds.token_uri,
+        "client_id": creds.client_id,
+        "client_secret": creds.client_secret,
+        "scopes": creds.scopes,
+    }
+
+
+# バックグラウンドリフレッシュの動作パラメータ
+_SWEEP_INTERVAL_SECONDS = 30
+_SWEEP_REFRESH_MARGIN_SECONDS = 60
+
+
+def _sweep_expiring_credentials() -> None:
+    """
+    キャッシュ済み認証情報を定期的に巡回し、期限間近のものを先回りで
+    リフレッシュする。リクエスト処理中にリフレッシュのRTTを払わずに済む。
+    """
+    while True:
+        time.sleep(_SWEEP_INTERVAL_SECONDS)
+        try:
+            now = datetime.datetime.utcnow()
+            with _credentials_cache_lock:
+                snapshot = list(_credentials_cache.items())
+            for key, creds in snapshot:
+                if not creds.refresh_token or creds.expiry is None:
+                    continue
+                if (creds.expiry - now).total_seconds() >= _SWEEP_REFRESH_MARGIN_SECONDS:
+                    continue
+
+                with _rebuild_locks_guard:
+                    lock = _rebuild_locks[key]
+                with lock:
+                    # ロック待ちの間にリフレッシュ済みならスキップ
+                    remaining = (creds.expiry - datetime.datetime.utcnow()).total_seconds()
+                    if remaining >= _SWEEP_REFRESH_MARGIN_SECONDS:
+                        continue
+                    creds.refresh(GoogleRequest())
+                    with _credentials_cache_lock:
+                        _credentials_cache[key] = creds
+                        user_id = _key_to_user.get(key)
+                    if user_id:
+                        save_user_tokens_async(user_id, _to_token_info(creds))
+        except Exception as e:
+            logger.warning("バックグラウンドのトークンリフレッシュに失敗しました: %s", e)
+
+
+_sweeper_thread = threading.Thread(
+    target=_sweep_expiring_credentials, daemon=True, name="token-refresh-sweeper"
+)
+_sweeper_thread.start()
+
+
+async def get_access_token(user_id: str) -> Optional[str]:
+    """
+    ユーザーのアクセストークンを非同期に取得する
+
+    Args:
+        user_id: ユーザーID
+
+    Returns:
+        アクセストークン文字列、認証情報が見つからない場合はNone
+    """
+    creds = await asyncio.to_thread(get_cached_credentials, user_id)
+    return creds.token if creds else None
+
+
+def invalidate_credentials(user_id: str) -> None:
+    """キャッシュ済みの認証情報を無効化する（再認証時に呼び出す）"""
+    with _credentials_cache_lock:
+        _credentials_cache.pop(_cache_key(user_id), None)
@@ -13,6 +13,24 @@ sys.path.append(str(root_dir))
 # LangGraphのインポート
 from app.services.langgraph_processor import AgentState
 
+# 代替出力用のDOTテンプレート（実際のグラフ構造と対応させておく）
+_DOT_TEMPLATE = """\
+digraph G {
+    rankdir=LR;
+    node [shape=box, style=filled, color=lightblue];
+
+    START [shape=oval, color=green];
+    END [shape=oval, color=red];
+
+    START -> should_use_tools;
+    should_use_tools -> use_tools [label="use_tools"];
+    should_use_tools -> generate_response [label="generate_response"];
+    use_tools -> update_chat_history;
+    generate_response -> update_chat_history;
+    update_chat_history -> END;
+}
+"""
+
 
 def main():
     """
@@ -31,24 +49,22 @@ def main():
     workflow = StateGraph(AgentState)
 
     # ノードの追加
-    workflow.add_node("parse_input", dummy_node)
-    workflow.add_node("retrieve_context", dummy_node)
+    workflow.add_node("should_use_tools", dummy_node)
     workflow.add_node("use_tools", dummy_node)
     workflow.add_node("generate_response", dummy_node)
     workflow.add_node("update_chat_history", dummy_node)
 
     # エッジの定義
-    workflow.set_entry_point("parse_input")
-    workflow.add_edge("parse_input", "retrieve_context")
+    workflow.set_entry_point("should_use_tools")
 
     # 条件付きエッジの定義
-    def should_use_tools(state):
+    def route(state):
         # ダミーの条件関数
         return "use_tools"
 
     workflow.add_conditional_edges(
-        "retrieve_context",
-        should_use_tools,
+        "should_use_tools",
+        route,
         {"use_tools": "use_tools", "generate_response": "generate_response"},
     )
 
@@ -79,41 +95,21 @@ def main():
 
             # DOT形式でも保存
             dot_path = os.path.join(root_dir, "graph_structure.dot")
-            with open(dot_path, "w") as f:
-                f.write(graph_viz.source)
+            Path(dot_path).write_text(graph_viz.source, encoding="utf-8")
             print(f"グラフ構造が {dot_path} に保存されました。")
 
         except AttributeError as e:
             print(f"LangGraphのビジュアライゼーションメソッドが見つかりません: {e}")
             print("代替方法として、DOT形式でグラフ構造を直接出力します...")
 
-            # 代替方法：DOTファイルを直接生成
-            dot_content = """
-            digraph G {
-                rankdir=LR;
-                node [shape=box, style=filled, color=lightblue];
-                
-                START [shape=oval, color=green];
-                END [shape=oval, color=red];
-                
-                START -> parse_input;
-                parse_input -> retrieve_context;
-                retrieve_context -> use_tools [label="use_tools"];
-                retrieve_context -> generate_response [label="generate_response"];
-                use_tools -> update_chat_history;
-                generate_response -> update_chat_history;
-                update_chat_history -> END;
-            }
-            """
-
+            # 代替方法：モジュール定数のDOTテンプレートをそのまま書き出す
             dot_path = os.path.join(root_dir, "graph_structure.dot")
-            with open(dot_path, "w") as f:
-                f.write(dot_content)
+            Path(dot_path).write_text(_DOT_TEMPLATE, encoding="utf-8")
             print(f"グラフ構造が {dot_path} に保存されました。")
 
             # DOTファイルからPNG画像を生成
             try:
-                g = graphviz.Source(dot_content)
+                g = graphviz.Source(_DOT_TEMPLATE)
                 output_path = os.path.join(root_dir, "graph_visualization")
                 g.render(output_path, format="png", cleanup=True)
                 print(f"グラフの視覚化が完了しました。画像は {output_path}.png に保存されました。")
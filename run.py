@@ -4,7 +4,14 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-port = int(os.getenv("PORT", 8080))  
+port = int(os.getenv("PORT", 8080))
 
 if __name__ == "__main__":
-    uvicorn.run("app.main:app", host="0.0.0.0", port=port, reload=True)
+    # reloadはファイルウォッチャーを起動しuvloop最適化を無効にするため、
+    # 開発時（DEV=1）のみ有効にする
+    uvicorn.run(
+        "app.main:app",
+        host="0.0.0.0",
+        port=port,
+        reload=bool(os.getenv("DEV")),
+    )
@@ -17,6 +17,9 @@ load_dotenv()
 # Firebaseデータベースマネージャーをインポート
 from app.services.firebase_database import FirebaseDatabaseManager
 
+# Firestoreのバッチ書き込み上限
+BATCH_SIZE = 500
+
 def migrate_data():
     """SQLiteからFirebaseへデータを移行する"""
     print("SQLiteからFirebaseへのデータ移行を開始します...")
@@ -32,40 +35,51 @@ def migrate_data():
     # Firebaseデータベースマネージャーを初期化
     firebase_db = FirebaseDatabaseManager()
     
-    # ユーザートークンデータを取得
+    # ユーザートークンデータをカーソルから逐次読み出す
+    # （fetchallで全行をメモリに載せない。列は名前付きの射影で取り出し、
+    #   位置インデックスのずれを防ぐ）
     print("ユーザートークンデータを取得中...")
-    cursor.execute("SELECT * FROM user_tokens")
-    rows = cursor.fetchall()
-    
-    # 各ユーザーのデータをFirebaseに移行
+    cursor.execute(
+        "SELECT user_id, token, refresh_token, token_uri, client_id, client_secret, scopes"
+        " FROM user_tokens"
+    )
+
+    # 1件ずつ保存するとユーザー数分のRPC往復になるため、
+    # Firestoreのバッチ上限（500件）ごとにまとめて書き込む
     success_count = 0
     error_count = 0
-    
-    for row in rows:
-        user_id = row[0]
-        token_info = {
-            "token": row[1],
-            "refresh_token": row[2],
-            "token_uri": row[3],
-            "client_id": row[4],
-            "client_secret": row[5],
-            "scopes": json.loads(row[6]) if row[6] else []
-        }
-        
-        print(f"ユーザー {user_id} のデータを移行中...")
-        
-        try:
-            # Firebaseにデータを保存
-            if firebase_db.save_user_tokens(user_id, token_info):
-                success_count += 1
-                print(f"  ✓ ユーザー {user_id} のデータを正常に移行しました")
-            else:
-                error_count += 1
-                print(f"  ✗ ユーザー {user_id} のデータ移行に失敗しました")
-        except Exception as e:
-            error_count += 1
-            print(f"  ✗ エラー: {e}")
-    
+    processed = 0
+    items = []
+
+    def flush():
+        nonlocal success_count, error_count, processed
+        if not items:
+            return
+        processed += len(items)
+        print(f"{processed}件目までを移行中...")
+        saved = firebase_db.save_user_tokens_bulk(items)
+        success_count += saved
+        error_count += len(items) - saved
+        items.clear()
+
+    for user_id, token, refresh_token, token_uri, client_id, client_secret, scopes in cursor:
+        items.append(
+            (
+                user_id,
+                {
+                    "token": token,
+                    "refresh_token": refresh_token,
+                    "token_uri": token_uri,
+                    "client_id": client_id,
+                    "client_secret": client_secret,
+                    "scopes": json.loads(scopes) if scopes else []
+                },
+            )
+        )
+        if len(items) >= BATCH_SIZE:
+            flush()
+    flush()
+
     # 結果を表示
     print("\n移行完了:")
     print(f"  成功: {success_count}")